@@ -25,9 +25,11 @@ log_level_to_string_map = {
 }
 
 
-def init_logging(log_level):
+def init_logging(log_level, stream="ext://sys.stdout"):
     """
     Init logging settings with default set to INFO
+
+    :param stream: Stream log messages are written to, stdout unless it's used for output.
     """
     level = log_level_to_string_map[log_level]
     message = "%(levelname)s:"
@@ -48,7 +50,7 @@ def init_logging(log_level):
                 "class": "logging.StreamHandler",
                 "level": level,
                 "formatter": "simple",
-                "stream": "ext://sys.stdout"
+                "stream": stream
             }
         },
         "formatters": {
@@ -68,6 +70,13 @@ class FileProcessingError(Exception):
     """
 
 
+class RenderLimitError(Exception):
+    """
+    RenderLimitError exception throwed when a render exceeds one of its
+    resource limits.
+    """
+
+
 class ExitError(Exception):
     """
     Custom exit error
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+""" Batch rendering of many targets described in a targets file """
+
+import json
+import math
+import os
+
+import yaml
+
+from djinja import FileProcessingError
+from djinja.workers import map_forked
+
+
+def load_targets(targets_file):
+    """
+    Load a list of render targets from a YAML or JSON file.
+
+    Every target is a mapping with the template to render ("dockerfile"),
+    where to write it ("outfile" or "outdir"), an optional "name" and "env"
+    values overriding the config for this target only:
+
+        - name: web
+          dockerfile: web/Dockerfile.jinja
+          outfile: web/Dockerfile
+          env:
+            OS: debian:8
+
+    Relative paths are relative to the directory of the targets file.
+    """
+    try:
+        with open(targets_file, "r") as stream:
+            data = yaml.safe_load(stream)
+    except (OSError, IOError, yaml.YAMLError) as e:
+        raise FileProcessingError(e, targets_file)
+
+    if not isinstance(data, list):
+        raise FileProcessingError("targets file must contain a list of targets", targets_file)
+
+    base = os.path.dirname(targets_file)
+    targets = []
+    names = set()
+    for n, item in enumerate(data):
+        if not isinstance(item, dict) or "dockerfile" not in item or not (item.get("outfile") or item.get("outdir")):
+            raise FileProcessingError("target {0} needs a dockerfile and an outfile or outdir".format(n), targets_file)
+
+        target = {
+            "dockerfile": os.path.join(base, item["dockerfile"]),
+            "outfile": os.path.join(base, item["outfile"]) if item.get("outfile") else None,
+            "outdir": os.path.join(base, item["outdir"]) if item.get("outdir") else None,
+            "env": item.get("env") or {},
+        }
+        target["name"] = str(item.get("name") or item.get("outfile") or item.get("outdir"))
+        if target["name"] in names:
+            raise FileProcessingError("target name '{0}' is used twice".format(target["name"]), targets_file)
+        names.add(target["name"])
+        targets.append(target)
+    return targets
+
+
+def parse_shard(text):
+    """
+    Parse a shard specification "I/N" into (I, N), shards count from 1.
+    """
+    index, sep, count = text.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not sep or count < 1 or not 1 <= index <= count:
+        raise ValueError("invalid shard '{0}', expected I/N with 1 <= I <= N".format(text))
+    return index, count
+
+
+def load_timings(timings_files):
+    """
+    Load render durations in seconds per target name from timings files.
+    Later files win. A missing file is treated as empty, so the first run
+    of a pipeline works without one.
+    """
+    timings = {}
+    for timings_file in timings_files:
+        try:
+            with open(timings_file, "r") as stream:
+                data = json.load(stream)
+        except (OSError, IOError):
+            continue
+        except ValueError as e:
+            raise FileProcessingError(e, timings_file)
+
+        if not isinstance(data, dict) or not isinstance(data.get("targets"), dict):
+            raise FileProcessingError("timings file must contain a 'targets' mapping", timings_file)
+        for name, seconds in data["targets"].items():
+            try:
+                seconds = float(seconds)
+            except (TypeError, ValueError) as e:
+                raise FileProcessingError(e, timings_file)
+            if math.isnan(seconds) or math.isinf(seconds) or seconds < 0:
+                raise FileProcessingError("invalid duration for target '{0}': {1}".format(name, seconds), timings_file)
+            timings[str(name)] = seconds
+    return timings
+
+
+def save_timings(timings_file, timings):
+    """
+    Merge render durations into a timings file. Durations of targets not
+    rendered in this run are kept, so files of all shards can be combined.
+    """
+    merged = load_timings([timings_file])
+    merged.update(timings)
+    try:
+        with open(timings_file, "w") as stream:
+            json.dump({"targets": dict((k, round(v, 4)) for k, v in merged.items())}, stream, indent=2, sort_keys=True)
+            stream.write("\n")
+    except (OSError, IOError) as e:
+        raise FileProcessingError(e, timings_file)
+
+
+def assign_shards(targets, count, timings):
+    """
+    Split targets into count shards that take about the same time to render.
+
+    Targets are handed out longest first, each to the shard with the least
+    total duration so far. Targets without a recorded duration are assumed
+    to take the average of the known ones. The result only depends on the
+    targets and timings, so every node computes the same split.
+    """
+    known = [timings[t["name"]] for t in targets if t["name"] in timings]
+    default = sum(known) / len(known) if known else 1.0
+
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for target in sorted(targets, key=lambda t: (-timings.get(t["name"], default), t["name"])):
+        n = min(range(count), key=lambda i: (loads[i], i))
+        shards[n].append(target)
+        loads[n] += timings.get(target["name"], default)
+
+    # Keep the order of the targets file within each shard
+    position = dict((t["name"], n) for n, t in enumerate(targets))
+    return [sorted(shard, key=lambda t: position[t["name"]]) for shard in shards]
+
+
+def schedule(targets, durations):
+    """
+    Order targets longest first by their expected durations, so a slow target
+    doesn't start last and stretch the whole run. Targets without a duration
+    may be slow as well and start first, ties keep the targets file order.
+    """
+    return sorted(targets, key=lambda t: -durations.get(t["name"], float("inf")))
+
+
+def run_targets(render, targets, jobs=1):
+    """
+    Call render for every target, with jobs worker processes if jobs > 1.
+    Targets are started in the given order and results are returned in it.
+    """
+    # One target per task, so idle workers pick up the next longest one
+    return map_forked(render, targets, jobs, 1)
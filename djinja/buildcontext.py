@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming of Docker build contexts.
+
+The rendered Dockerfile and the files of the context directory are written
+as a tar stream one entry at a time, file bodies are copied by the kernel
+with sendfile when the destination allows it.
+"""
+
+import errno
+import io
+import logging
+import os
+import re
+import socket
+import stat
+import tarfile
+
+Log = logging.getLogger(__name__)
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+COPY_BUFSIZE = 64 * 1024
+
+# Files the docker daemon always needs, even if .dockerignore lists them
+ALWAYS_INCLUDED = ("Dockerfile", ".dockerignore")
+
+
+def _translate_pattern(pattern):
+    """
+    Translate a .dockerignore pattern into a regular expression.
+    """
+    regex = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern[i:i + 3] == "**/":
+                regex.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern[i:i + 2] == "**":
+                regex.append(".*")
+                i += 2
+                continue
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex.append(re.escape(c))
+            else:
+                group = pattern[i + 1:end]
+                if group.startswith("^") or group.startswith("!"):
+                    group = "^" + group[1:]
+                regex.append("[" + group.replace("\\", "\\\\") + "]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return re.compile("".join(regex) + r"\Z")
+
+
+class DockerIgnore(object):
+    """
+    Matcher for .dockerignore patterns. A path is ignored if the last pattern
+    matching it or one of its parent directories isn't an exception.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            exclusion = pattern.startswith("!")
+            if exclusion:
+                pattern = pattern[1:].strip()
+            pattern = os.path.normpath(pattern).lstrip("/")
+            if pattern == os.curdir:
+                continue
+            self.patterns.append((_translate_pattern(pattern), exclusion))
+        self.has_exclusions = any(p[1] for p in self.patterns)
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(text.splitlines())
+
+    def matches(self, path):
+        parts = path.split("/")
+        # Patterns also match every file below a matching directory
+        candidates = ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+        ignored = False
+        for regex, exclusion in self.patterns:
+            if any(regex.match(c) for c in candidates):
+                ignored = not exclusion
+        return ignored
+
+
+class TarStream(object):
+    """
+    Writes a tar archive entry by entry to a binary file object.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+
+    def _fileno(self):
+        try:
+            return self.fileobj.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return None
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def _pad(self, size):
+        remainder = size % BLOCKSIZE
+        if remainder:
+            self._write(tarfile.NUL * (BLOCKSIZE - remainder))
+
+    def _header(self, info):
+        self._write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+
+    def add_bytes(self, name, data, mtime=0, mode=0o644):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        info.mode = mode
+        self._header(info)
+        self._write(data)
+        self._pad(info.size)
+
+    def add_path(self, name, path):
+        """
+        Add a file, directory or symlink from disk. Other file types are skipped.
+        """
+        st = os.lstat(path)
+        info = tarfile.TarInfo(name)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = int(st.st_mtime)
+        info.uid, info.gid = st.st_uid, st.st_gid
+
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+            self._header(info)
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+            self._header(info)
+        elif stat.S_ISREG(st.st_mode):
+            info.size = st.st_size
+            with open(path, "rb") as stream:
+                self._header(info)
+                self._copy(stream, info.size)
+            self._pad(info.size)
+        else:
+            Log.debug("Skipping special file %s", path)
+
+    def _copy(self, stream, size):
+        out_fd = self._fileno()
+        offset = 0
+        if out_fd is not None and hasattr(os, "sendfile"):
+            self.fileobj.flush()
+            try:
+                while offset < size:
+                    sent = os.sendfile(out_fd, stream.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError as e:
+                # Destination doesn't support sendfile, copy through userspace
+                if offset or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+            self.offset += offset
+            stream.seek(offset)
+
+        while offset < size:
+            chunk = stream.read(min(COPY_BUFSIZE, size - offset))
+            if not chunk:
+                break
+            self._write(chunk)
+            offset += len(chunk)
+
+        if offset != size:
+            raise IOError("file changed size while streaming: {0}".format(stream.name))
+
+    def close(self):
+        # End of archive marker is two empty blocks
+        self._write(tarfile.NUL * (BLOCKSIZE * 2))
+        self.fileobj.flush()
+
+
+def iter_context(context_dir, ignore, skip=()):
+    """
+    Yield (name, path) for every entry of the context directory that isn't
+    ignored, in a stable order.
+    """
+    skip = set(os.path.realpath(p) for p in skip)
+    for root, dirnames, filenames in os.walk(context_dir):
+        dirnames.sort()
+        rel_root = os.path.relpath(root, context_dir)
+        rel_root = "" if rel_root == os.curdir else rel_root.replace(os.sep, "/") + "/"
+
+        for dirname in list(dirnames):
+            name = rel_root + dirname
+            if ignore.matches(name):
+                # Exceptions may re-include files below an ignored directory
+                if not ignore.has_exclusions:
+                    dirnames.remove(dirname)
+                continue
+            yield name, os.path.join(root, dirname)
+
+        for filename in sorted(filenames):
+            name = rel_root + filename
+            path = os.path.join(root, filename)
+            if os.path.realpath(path) in skip:
+                continue
+            if ignore.matches(name) and name not in ALWAYS_INCLUDED:
+                continue
+            yield name, path
+
+
+def stream_build_context(fileobj, context_dir, rendered, mtime=0, skip=()):
+    """
+    Write the build context tar stream to fileobj.
+
+    :param context_dir: Directory with the files of the build context.
+    :param rendered: Mapping of name to text for rendered files, they take
+                     precedence over files with the same name in the context.
+    :param mtime: Modification time of the rendered files.
+    :param skip: Paths that must never be added, e.g. the output file itself.
+    """
+    if ".dockerignore" in rendered:
+        ignore = DockerIgnore.from_text(rendered[".dockerignore"])
+    else:
+        try:
+            with open(os.path.join(context_dir, ".dockerignore"), "r") as stream:
+                ignore = DockerIgnore.from_text(stream.read())
+        except (OSError, IOError):
+            ignore = DockerIgnore([])
+
+    tar = TarStream(fileobj)
+    for name, data in rendered.items():
+        tar.add_bytes(name, data.encode("utf-8"), mtime)
+
+    count = 0
+    for name, path in iter_context(context_dir, ignore, skip):
+        if name not in rendered:
+            tar.add_path(name, path)
+            count += 1
+
+    tar.close()
+    Log.debug("Streamed %s context entries, %s bytes", count, tar.offset)
+    return tar.offset
+
+
+def open_socket(address):
+    """
+    Connect to a unix socket ("unix:/path" or a path) or a tcp address ("host:port").
+    """
+    if address.startswith("unix:"):
+        address = address[len("unix:"):]
+    elif ":" in address and "/" not in address:
+        host, port = address.rsplit(":", 1)
+        return socket.create_connection((host, int(port)))
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""
+Static validation of templates.
+
+Templates are parsed and compiled but never rendered. Syntax errors,
+unknown filters and tests, undefined variables and config keys missing
+from the config tree are reported.
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from jinja2 import meta, nodes
+from jinja2.exceptions import TemplateAssertionError, TemplateSyntaxError
+
+from djinja.partial import RUNTIME_NAMES
+from djinja.workers import map_forked
+
+Log = logging.getLogger(__name__)
+
+# Below this number of templates a worker pool costs more than it saves
+MIN_PARALLEL_TEMPLATES = 50
+
+# Bumped when the analysis changes, so cached results of older versions are ignored
+CACHE_VERSION = 2
+
+# Attributes of config mappings that are methods, not keys
+_MAPPING_METHODS = frozenset(n for n in dir(dict) if not n.startswith("_"))
+
+# Tests and filters that make a missing key safe to look up
+_GUARD_TESTS = frozenset(["defined", "undefined"])
+_GUARD_FILTERS = frozenset(["default", "d"])
+
+
+def find_templates(paths):
+    """
+    Expand directories into the *.jinja files found below them.
+    """
+    templates = []
+    for path in paths:
+        if not os.path.isdir(path):
+            templates.append(path)
+            continue
+        for root, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            templates.extend(os.path.join(root, f) for f in sorted(filenames) if f.endswith(".jinja"))
+    return templates
+
+
+def _key_chain(node):
+    """
+    Return (name, [keys]) for a chain like foo.bar['baz'] or None.
+    """
+    keys = []
+    while True:
+        if isinstance(node, nodes.Getattr):
+            keys.append(node.attr)
+        elif isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const):
+            keys.append(node.arg.value)
+        elif isinstance(node, nodes.Name):
+            return node.name, keys[::-1]
+        else:
+            return None
+        node = node.node
+
+
+def _overlaps(chain, other):
+    """
+    True if one key chain is the start of the other.
+    """
+    n = min(len(chain[1]), len(other[1]))
+    return chain[0] == other[0] and chain[1][:n] == other[1][:n]
+
+
+class TemplateChecker(object):
+    """
+    Checks templates against an environment and a config tree.
+    """
+
+    def __init__(self, environment, config, cache_dir=None, fingerprint=""):
+        """
+        :param environment: Environment with all globals, filters and extensions loaded.
+        :param config: Config tree templates are rendered with.
+        :param cache_dir: Directory to cache results of unchanged templates in.
+        :param fingerprint: Identifies environment and config in cached results.
+        """
+        self.environment = environment
+        self.config = config
+        self.cache_dir = os.path.join(cache_dir, "check") if cache_dir else None
+        self.fingerprint = fingerprint
+        self.known_names = set(environment.globals) | set(config) | RUNTIME_NAMES
+
+    def check_file(self, path):
+        """
+        Return a list of "path:line: message" issues for a template file.
+        """
+        try:
+            with open(path, "r") as stream:
+                source = stream.read()
+        except (OSError, IOError) as e:
+            return ["{0}: {1}".format(path, e)]
+
+        return ["{0}:{1}: {2}".format(path, line, message) for line, message in self.check_source(source)]
+
+    def check_source(self, source):
+        """
+        Return a sorted list of (line, message) issues for template source.
+        """
+        cache_path = None
+        if self.cache_dir:
+            key = "{0}\0{1}\0{2}".format(CACHE_VERSION, self.fingerprint, source)
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+            cache_path = os.path.join(self.cache_dir, digest + ".json")
+            try:
+                with open(cache_path, "r") as stream:
+                    return [tuple(issue) for issue in json.load(stream)]
+            except (OSError, IOError, ValueError):
+                pass
+
+        issues = sorted(set(self._analyse(source)))
+
+        if cache_path:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                with open(cache_path, "w") as stream:
+                    json.dump(issues, stream)
+            except (OSError, IOError) as e:
+                Log.warning("Unable to write check cache file %s: %s", cache_path, e)
+        return issues
+
+    def _analyse(self, source):
+        try:
+            ast = self.environment.parse(source)
+        except TemplateSyntaxError as e:
+            return [(e.lineno or 0, "syntax error: {0}".format(e.message))]
+
+        # Collect everything in a single walk over the tree
+        issues = []
+        first_use = {}
+        lookups = []
+        callees = set()
+        guarded = []
+        for node in ast.find_all(nodes.Node):
+            if isinstance(node, (nodes.Filter, nodes.Test)) and node.node is not None:
+                if node.name in (_GUARD_TESTS if isinstance(node, nodes.Test) else _GUARD_FILTERS):
+                    chain = _key_chain(node.node)
+                    if chain is not None:
+                        guarded.append(chain)
+
+            if isinstance(node, nodes.Filter) and node.name not in self.environment.filters:
+                issues.append((node.lineno, "unknown filter '{0}'".format(node.name)))
+            elif isinstance(node, nodes.Test) and node.name not in self.environment.tests:
+                issues.append((node.lineno, "unknown test '{0}'".format(node.name)))
+            elif isinstance(node, nodes.Call):
+                callees.add(id(node.node))
+            elif isinstance(node, nodes.Name):
+                first_use.setdefault(node.name, node.lineno)
+            elif isinstance(node, (nodes.Getattr, nodes.Getitem)):
+                lookups.append(node)
+
+        try:
+            # Runs the code generator, which also reports errors like blocks
+            # defined twice. Compiling the generated python code adds nothing.
+            undeclared = meta.find_undeclared_variables(ast)
+        except TemplateAssertionError as e:
+            # Unknown filters and tests are already reported with their names
+            if not issues:
+                issues.append((e.lineno or 0, e.message))
+            return issues
+
+        for name in sorted(undeclared - self.known_names):
+            issues.append((first_use.get(name, 0), "undefined variable '{0}'".format(name)))
+
+        issues.extend(self._check_config_keys(lookups, undeclared, callees, guarded))
+        return issues
+
+    def _check_config_keys(self, lookups, undeclared, callees=(), guarded=()):
+        """
+        Report keys missing in the config tree for chains like foo.bar['baz']
+        that start at a config key.
+
+        Lookups that are called, like foo.get('x'), are method calls and chains
+        tested with "is defined" or passed to "default" anywhere in the template
+        may be missing.
+        """
+        issues = []
+        for node in lookups:
+            chain = _key_chain(node)
+            if chain is None or chain[0] not in undeclared or chain[0] not in self.config:
+                continue
+            if id(node) in callees or any(_overlaps(chain, g) for g in guarded):
+                continue
+
+            name, keys = chain
+            value = self.config[name]
+            path = name
+            for key in keys:
+                if not isinstance(value, Mapping):
+                    # Attributes of lists, strings etc. aren't config keys
+                    break
+                path = "{0}.{1}".format(path, key)
+                if key not in value and key in _MAPPING_METHODS:
+                    break
+                if key not in value:
+                    issues.append((node.lineno, "config key '{0}' is missing".format(path)))
+                    break
+                value = value[key]
+        return issues
+
+
+def run_checks(checker, paths, jobs=None):
+    """
+    Check all template paths, in parallel when there are enough of them.
+    Returns a list of issues in the order of paths.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    if len(paths) < MIN_PARALLEL_TEMPLATES:
+        jobs = 1
+    chunksize = max(1, len(paths) // (jobs * 4))
+    results = map_forked(checker.check_file, paths, jobs, chunksize)
+    return [issue for issues in results for issue in issues]
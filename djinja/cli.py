@@ -18,15 +18,56 @@ def main():
 
     __docopt__ = """
     Usage:
-      dj -d DOCKERFILE -o OUTFILE [-s DSFILE]... [-e ENV]... [-c CONFIGFILE]...
-         [-v ...] [-q] [-h] [--version]
+      dj -d DOCKERFILE (-o OUTFILE | -O OUTDIR | --socket ADDR) [-b CONTEXT]
+         [-s DSFILE]... [-e ENV]... [--env-prefix PREFIX] [--env-file FILE]... [-c CONFIGFILE]...
+         [--lazy-config] [--cache-dir DIR] [--cache-ttl SECONDS] [--cache-size N] [--vary NAME]...
+         [--timeout SECONDS] [--max-output N] [--max-loop N] [--max-depth N] [--sandbox]
+         [--layer-report FILE] [-v ...] [-q] [-h] [--version]
+      dj batch TARGETS [--shard I/N] [--timings FILE]... [--save-timings FILE] [-j JOBS] [--history FILE]
+         [-s DSFILE]... [-e ENV]... [--env-prefix PREFIX] [--env-file FILE]... [-c CONFIGFILE]...
+         [--lazy-config] [--cache-dir DIR] [--cache-ttl SECONDS] [--cache-size N] [--vary NAME]...
+         [--timeout SECONDS] [--max-output N] [--max-loop N] [--max-depth N] [--sandbox]
+         [--layer-report FILE] [-v ...] [-q]
+      dj --stream
+         [-s DSFILE]... [-e ENV]... [--env-prefix PREFIX] [--env-file FILE]... [-c CONFIGFILE]...
+         [--lazy-config] [--cache-dir DIR] [--cache-ttl SECONDS] [--cache-size N] [--vary NAME]...
+         [--timeout SECONDS] [--max-output N] [--max-loop N] [--max-depth N] [--sandbox]
+         [-v ...] [-q]
+      dj check PATH... [-j JOBS]
+         [-s DSFILE]... [-e ENV]... [--env-prefix PREFIX] [--env-file FILE]... [-c CONFIGFILE]...
+         [--lazy-config] [--cache-dir DIR] [-v ...] [-q]
+      dj stats (--history FILE | --cache-dir DIR) [--top N] [--json] [-v ...] [-q]
 
     Options:
       -c CONFIGFILE --config CONFIGFILE       file containing data config for dj (yaml or json format)
       -s DSFILE --datasource DSFILE           file that should be loaded as a datasource
-      -d DOCKERFILE --dockerfile DOCKERFILE   dockerfile to render
+      -d DOCKERFILE --dockerfile DOCKERFILE   dockerfile to render, "-" reads it from stdin
       -e ENV --env ENV                        variable with form "key=value" that should be used in the rendering
-      -o OUTFILE --outfile OUTFILE            output result to file
+      --env-prefix PREFIX                     only expose environment variables starting with PREFIX as env, without the prefix
+      --env-file FILE                         dotenv file with defaults for env, parsed only when a template uses env
+      -o OUTFILE --outfile OUTFILE            output result to file, "-" writes it to stdout
+      -O OUTDIR --outdir OUTDIR               write the Dockerfile and all named outputs into directory
+      -b CONTEXT --build-context CONTEXT      write a docker build context tar stream of CONTEXT and the rendered files
+      --socket ADDR                           send the build context stream to a socket, "unix:PATH" or "HOST:PORT"
+      --lazy-config                           index config files and only load the top level keys a template uses
+      --cache-dir DIR                         persist {% cache %} fragments in DIR between runs
+      --cache-ttl SECONDS                     expire cached fragments after SECONDS
+      --cache-size N                          keep at most N cached fragments in memory
+      --stream                                render JSON requests read line by line from stdin, see README
+      -j JOBS --jobs JOBS                     number of parallel workers, check defaults to the number of cores and batch to 1
+      --vary NAME                             variable that changes between renders, everything else is precomputed once
+      --timeout SECONDS                       fail a render that runs longer than SECONDS
+      --max-output N                          fail a render that produces more than N characters
+      --max-loop N                            fail a render that runs more than N loop iterations
+      --max-depth N                           fail a render that nests calls deeper than N, e.g. recursive macros
+      --sandbox                               render in a sandbox that blocks access to unsafe attributes
+      --shard I/N                             only render shard I of N, balanced by the durations in the timings files
+      --timings FILE                          timings file with render durations of a previous batch, used to balance shards
+      --save-timings FILE                     merge the render durations of this batch into timings file FILE
+      --history FILE                          record durations and cache counters of batch runs, defaults to DIR/history.jsonl with --cache-dir
+      --top N                                 number of slowest targets stats shows, defaults to 10
+      --json                                  print stats as JSON
+      --layer-report FILE                     write predicted docker layer cache invalidations as JSON, "-" writes to stdout
       -h --help                               show this help
       -v --verbosity                          verbosity level of logging messages. ( -v == CRITICAL )  ( -vvvvv == DEBUG )
       -V --version                            display the version number and exit
@@ -35,7 +76,11 @@ def main():
 
     args = docopt(__docopt__, version=djinja.__version__)
 
-    djinja.init_logging(1 if args["--quiet"] else args["--verbosity"])
+    # Keep stdout clean when it carries rendered output
+    log_stream = "ext://sys.stdout"
+    if args["--stream"] or args["check"] or args["stats"] or "-" in (args["--outfile"], args["--layer-report"]):
+        log_stream = "ext://sys.stderr"
+    djinja.init_logging(1 if args["--quiet"] else args["--verbosity"], log_stream)
 
     # Import rest of application so logging will work for them correctely
     import djinja.main
@@ -2,17 +2,306 @@
 
 import json
 import logging
+import os
+import re
 import yaml
 
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
 from djinja import FileProcessingError, ExitError
 
 Log = logging.getLogger(__name__)
 
+# Top level key of a block style YAML mapping: a line starting at column 0
+# that is neither a comment, a sequence entry nor a document marker.
+_yaml_top_key = re.compile(br"^(?![\s#?\-]|\.\.\.)([^\r\n]*?):(?=[ \t]|\r?$)", re.MULTILINE)
 
-class ConfTree(object):
+# YAML constructs whose meaning spans top level keys (anchors, aliases, merge
+# keys, tags, directives and multiple documents). Files using them can't be
+# split into independent subtrees and are loaded eagerly instead.
+_yaml_unsplittable = re.compile(br"(?:^|[\s\[{,])[&*!][^\s\[\]{},]|^(?:%|---|<<)", re.MULTILINE)
+
+_json_string = re.compile(br'"(?:[^"\\]|\\.)*"')
+_json_token = re.compile(br'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+_json_scalar = re.compile(br'[^,}\]\s]+')
+_json_skip = re.compile(br'[\s,]*')
+
+# Per-process cache of config indexes, keyed by path and validated by stat
+_index_cache = {}
+
+
+def _file_signature(st):
+    return (st.st_ino, st.st_size, getattr(st, "st_mtime_ns", st.st_mtime))
+
+
+class ConfigIndex(object):
+    """
+    Top level index of a config file.
+
+    The file is read once to record the byte span of every top level key,
+    only the spans are kept. A subtree is read from the file, decoded and
+    parsed the first time it is loaded and kept for the lifetime of the index.
+    """
+
+    def __init__(self, path, signature, buf, fmt):
+        self.path = path
+        self.signature = signature
+        # File content, only held while indexing
+        self.buf = buf
+        self.format = fmt
+        self.spans = {}
+        self.parsed = {}
+
+    def keys(self):
+        return self.spans.keys()
+
+    def load(self, key):
+        if key in self.parsed:
+            return self.parsed[key]
+
+        start, end = self.spans[key]
+        try:
+            with open(self.path, "rb") as stream:
+                if _file_signature(os.fstat(stream.fileno())) != self.signature:
+                    return self._load_changed(key, stream)
+                stream.seek(start)
+                data = stream.read(end - start).decode("utf-8")
+        except (OSError, IOError) as e:
+            raise FileProcessingError(e, self.path)
+
+        Log.debug("Parsing `%s' from config file `%s'", key, self.path)
+        try:
+            if self.format == "json":
+                value = json.loads(data)
+            else:
+                value = yaml.safe_load(data)[key]
+        except Exception as e:
+            raise FileProcessingError(e, self.path)
+
+        self.parsed[key] = value
+        return value
+
+    def _load_changed(self, key, stream):
+        """
+        The file changed since it was indexed, so the spans are stale. Load
+        the whole file as it is now instead.
+        """
+        Log.debug("Config file `%s' changed since it was indexed, loading it completely", self.path)
+        try:
+            data = yaml.safe_load(stream.read().decode("utf-8"))
+        except Exception as e:
+            raise FileProcessingError(e, self.path)
+        if not isinstance(data, dict) or key not in data:
+            raise FileProcessingError("key '{0}' was removed after the file was indexed".format(key), self.path)
+        self.parsed[key] = data[key]
+        return data[key]
+
+    def index_yaml(self):
+        """
+        Index a block style YAML mapping. Returns False if the file can't be
+        split at the top level.
+        """
+        if _yaml_unsplittable.search(self.buf):
+            return False
+
+        matches = list(_yaml_top_key.finditer(self.buf))
+        if not matches:
+            return False
+
+        # Anything but comments or blank lines before the first key means
+        # the document is not a mapping
+        for line in self.buf[:matches[0].start()].splitlines():
+            if line.strip() and not line.lstrip().startswith(b"#"):
+                return False
+
+        for n, match in enumerate(matches):
+            end = matches[n + 1].start() if n + 1 < len(matches) else len(self.buf)
+            key = yaml.safe_load(match.group(1).decode("utf-8"))
+            self.spans[key] = (match.start(), end)
+        return True
+
+    def index_json(self):
+        """
+        Index a JSON object by skipping over its top level values without
+        building them. Returns False on anything unexpected.
+        """
+        buf = self.buf
+        pos = _json_skip.match(buf, 0).end()
+        if buf[pos:pos + 1] != b"{":
+            return False
+        pos += 1
+
+        while True:
+            pos = _json_skip.match(buf, pos).end()
+            if buf[pos:pos + 1] == b"}":
+                return True
+
+            match = _json_string.match(buf, pos)
+            if match is None:
+                return False
+            key = json.loads(match.group().decode("utf-8"))
+
+            pos = _json_skip.match(buf, match.end()).end()
+            if buf[pos:pos + 1] != b":":
+                return False
+            pos = _json_skip.match(buf, pos + 1).end()
+
+            end = self._json_value_end(pos)
+            if end is None:
+                return False
+            self.spans[key] = (pos, end)
+            pos = end
+
+    def _json_value_end(self, pos):
+        first = self.buf[pos:pos + 1]
+        if first in (b"{", b"["):
+            depth = 0
+            for match in _json_token.finditer(self.buf, pos):
+                token = match.group()
+                if token in (b"{", b"["):
+                    depth += 1
+                elif token in (b"}", b"]"):
+                    depth -= 1
+                    if depth == 0:
+                        return match.end()
+            return None
+
+        match = (_json_string if first == b'"' else _json_scalar).match(self.buf, pos)
+        return match.end() if match else None
+
+
+def get_config_index(config_file):
+    """
+    Return a ConfigIndex for given config file or None when the file must be
+    loaded eagerly. Indexes are reused while the file is unchanged on disk.
+    """
+    try:
+        with open(config_file, "rb") as stream:
+            signature = _file_signature(os.fstat(stream.fileno()))
+
+            cached = _index_cache.get(config_file)
+            if cached is not None and cached.signature == signature:
+                return cached
+
+            buf = stream.read()
+            if not buf:
+                return None
+    except (OSError, IOError) as e:
+        raise FileProcessingError(e)
+
+    head = buf[:_json_skip.match(buf, 0).end() + 1].strip()
+    fmt = "json" if head == b"{" else "yaml"
+    index = ConfigIndex(config_file, signature, buf, fmt)
+    try:
+        ok = index.index_json() if fmt == "json" else index.index_yaml()
+    except (ValueError, yaml.YAMLError):
+        ok = False
+    # Subtrees are read from the file when loaded, don't keep its content
+    index.buf = None
+
+    if not ok:
+        _index_cache.pop(config_file, None)
+        return None
+
+    _index_cache[config_file] = index
+    return index
+
+
+class LazyTree(MutableMapping):
+    """
+    Config data tree whose values are materialized on first access.
+
+    Values set directly are kept as they are, values coming from an indexed
+    config file are loaded from it only when a key is looked up.
+    """
 
     def __init__(self):
-        self.tree = {}
+        self.values = {}
+        self.pending = {}
+
+    def merge_index(self, index):
+        for key in index.keys():
+            self.values.pop(key, None)
+            self.pending[key] = index
+
+    def __getitem__(self, key):
+        if key not in self.values and key in self.pending:
+            self.values[key] = self.pending.pop(key).load(key)
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.pending.pop(key, None)
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        if self.pending.pop(key, None) is None:
+            del self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values or key in self.pending
+
+    def __iter__(self):
+        for key in self.values:
+            yield key
+        for key in self.pending:
+            yield key
+
+    def __len__(self):
+        return len(self.values) + len(self.pending)
+
+    def __repr__(self):
+        # Never force pending subtrees just to print the tree
+        return "<LazyTree loaded={0!r} pending={1!r}>".format(self.values, sorted(self.pending, key=str))
+
+
+class ContextChain(Mapping):
+    """
+    Read only view over several mappings, the first mapping holding a key wins.
+    Lookups are delegated so no mapping in the chain is ever copied.
+    """
+
+    def __init__(self, *maps):
+        self.maps = maps
+
+    def __getitem__(self, key):
+        for m in self.maps:
+            if key in m:
+                return m[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return any(key in m for m in self.maps)
+
+    def __iter__(self):
+        seen = set()
+        for m in self.maps:
+            for key in m:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self.maps))
+
+    def copy(self):
+        # Jinja copies the context when it needs all of it at once, e.g. to
+        # rewrite tracebacks. Only then is everything materialized.
+        return dict(self)
+
+
+class ConfTree(object):
+
+    def __init__(self, lazy=False):
+        """
+        :param lazy: Index config files and load top level subtrees on demand.
+        """
+        self.lazy = lazy
+        self.tree = LazyTree() if lazy else {}
+        # Incremented whenever data is merged, so results derived from the tree can be invalidated
+        self.generation = 0
 
     def load_config_files(self, config_files, **kwargs):
         """
@@ -37,6 +326,14 @@ class ConfTree(object):
         """
         Load YAML or JSON from given config file and merge data tree
         """
+        if self.lazy:
+            index = get_config_index(config_file)
+            if index is not None:
+                Log.debug("Indexed %s top level keys from config file `%s'", len(index.spans), config_file)
+                self.tree.merge_index(index)
+                self.generation += 1
+                return
+
         try:
             with open(config_file, "r") as stream:
                 data = stream.read()
@@ -69,6 +366,7 @@ class ConfTree(object):
             raise Exception("Data tree to merge must be of dict type")
 
         self.tree.update(data_tree)
+        self.generation += 1
 
     def get_tree(self):
         return self.tree
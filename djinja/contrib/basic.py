@@ -3,9 +3,6 @@ import os
 
 def _global_env_var_is(key, value):
     """
-    Check if file exists on disk or not.
+    Check if environment variable is set to given value.
     """
-    if key not in os.environ:
-        return False
-    else:
-        return os.environ[key] == value
+    return os.environ.get(key) == value
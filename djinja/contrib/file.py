@@ -1,4 +1,37 @@
+import codecs
+import glob
+import mmap
 import os
+import stat
+
+from jinja2.utils import LRUCache
+
+# Number of file contents kept, least recently used are dropped first
+CONTENT_CACHE_SIZE = 64
+
+# Per-process cache of embedded file contents, keyed by real path and
+# validated against the file's stat signature on every lookup.
+_content_cache = LRUCache(CONTENT_CACHE_SIZE)
+
+
+def _stat_signature(st):
+    return (st.st_ino, st.st_size, getattr(st, "st_mtime_ns", st.st_mtime))
+
+
+def _read_mapped(path, size, encoding):
+    """
+    Read a file as text through a read-only memory map. The mapped pages are
+    decoded in place, without copying them into a bytes object first.
+    """
+    with open(path, "rb") as stream:
+        # Empty files can't be mapped
+        if size == 0:
+            return u""
+        m = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return codecs.decode(m, encoding)
+        finally:
+            m.close()
 
 
 def _global_file_exists(path):
@@ -6,3 +39,86 @@ def _global_file_exists(path):
     Check if file exists on disk or not.
     """
     return os.path.exists(path)
+
+
+def _global_file_contents(path, encoding="utf-8"):
+    """
+    Return the contents of a file as text.
+
+    The contents of the most recently used files are cached and re-read only
+    when the inode, size or modification time of the file changes.
+    """
+    real_path = os.path.realpath(path)
+    st = os.stat(real_path)
+    if not stat.S_ISREG(st.st_mode):
+        raise IOError("not a regular file: {0}".format(path))
+
+    signature = _stat_signature(st)
+    cached = _content_cache.get((real_path, encoding))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    data = _read_mapped(real_path, st.st_size, encoding)
+    _content_cache[(real_path, encoding)] = (signature, data)
+    return data
+
+
+def _list_directory(path):
+    """
+    Return the names in a directory and the names of symlinks among them.
+    """
+    scandir = getattr(os, "scandir", None)
+    if scandir is None:
+        # Without scandir symlinks can't be told apart from the listing
+        names = frozenset(os.listdir(path))
+        return names, names
+
+    names, links = set(), set()
+    for entry in scandir(path):
+        names.add(entry.name)
+        if entry.is_symlink():
+            links.add(entry.name)
+    return frozenset(names), frozenset(links)
+
+
+def _global_files_exist(paths):
+    """
+    Check a list of paths for existence and return a list of booleans.
+
+    Paths are grouped by parent directory and every directory is listed only
+    once, instead of probing each path with its own syscall. The result is
+    the same as file_exists for every path.
+    """
+    listings = {}
+    result = []
+    for path in paths:
+        head, tail = os.path.split(os.path.normpath(path))
+        if tail in ("", os.curdir, os.pardir) or path.endswith(("/", os.sep)):
+            # Directory references can't be resolved from a parent listing
+            result.append(os.path.exists(path))
+            continue
+
+        head = head or os.curdir
+        if head not in listings:
+            try:
+                listings[head] = _list_directory(head)
+            except OSError:
+                # Directories may be searchable without being listable
+                listings[head] = None
+        if listings[head] is None:
+            result.append(os.path.exists(path))
+            continue
+        names, links = listings[head]
+        if tail in links:
+            # A symlink exists only if its target does
+            result.append(os.path.exists(path))
+        else:
+            result.append(tail in names)
+    return result
+
+
+def _global_glob(pattern):
+    """
+    Return a sorted list of paths matching a shell style pattern.
+    """
+    return sorted(glob.glob(pattern))
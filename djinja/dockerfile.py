@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parsing and comparison of rendered Dockerfiles.
+
+Docker reuses a cached layer as long as the instruction and every
+instruction before it are unchanged. Comparing a new render with the
+previous one instruction by instruction predicts the first layer that has
+to be rebuilt.
+"""
+
+import re
+
+_directive = re.compile(r"^#\s*([a-zA-Z][a-zA-Z0-9_]*)\s*=\s*(.*?)\s*$")
+# A heredoc starts a shell word, so shifts like $((1<<X)) are not matched
+_heredoc = re.compile(r"(?:^|(?<=\s))<<-?([\"']?)([A-Za-z_][A-Za-z0-9_]*)\1")
+
+# Instructions whose cache key also depends on files of the build context
+CONTEXT_INSTRUCTIONS = ("ADD", "COPY")
+
+# Instructions that accept heredocs
+HEREDOC_INSTRUCTIONS = ("RUN", "COPY", "ADD")
+
+
+class Instruction(object):
+
+    def __init__(self, lineno, keyword, arguments):
+        """
+        :param lineno: Line the instruction starts on, counting from 1.
+        :param keyword: Instruction keyword in upper case, e.g. RUN.
+        :param arguments: Arguments with line continuations joined.
+        """
+        self.lineno = lineno
+        self.keyword = keyword
+        self.arguments = arguments
+
+    def __eq__(self, other):
+        return (self.keyword, self.arguments) == (other.keyword, other.arguments)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return "{0} {1}".format(self.keyword, self.arguments).rstrip()
+
+
+def parse_instructions(text):
+    """
+    Split a Dockerfile into its instructions.
+
+    Handles parser directives, comments, empty lines, line continuations with
+    the configured escape character and heredocs.
+    """
+    lines = text.splitlines()
+    escape = "\\"
+
+    # Parser directives are only valid before any other line
+    n = 0
+    while n < len(lines):
+        match = _directive.match(lines[n])
+        if match is None:
+            break
+        if match.group(1).lower() == "escape" and match.group(2) in ("\\", "`"):
+            escape = match.group(2)
+        n += 1
+
+    instructions = []
+    while n < len(lines):
+        line = lines[n].strip()
+        start = n
+        n += 1
+        if not line or line.startswith("#"):
+            continue
+
+        parts = []
+        while line.endswith(escape) and n < len(lines):
+            parts.append(line[:-1].rstrip())
+            # Comments and empty lines inside a continuation are dropped
+            while n < len(lines) and (not lines[n].strip() or lines[n].lstrip().startswith("#")):
+                n += 1
+            line = lines[n].strip() if n < len(lines) else ""
+            n += 1
+        parts.append(line[:-1].rstrip() if line.endswith(escape) else line)
+        joined = " ".join(p for p in parts if p)
+
+        # Heredoc bodies belong to the instruction
+        keyword = joined.partition(" ")[0].upper()
+        for match in _heredoc.finditer(joined) if keyword in HEREDOC_INSTRUCTIONS else ():
+            body = []
+            while n < len(lines) and lines[n].strip() != match.group(2):
+                body.append(lines[n])
+                n += 1
+            n += 1
+            joined = "\n".join([joined] + body + [match.group(2)])
+
+        keyword, _, arguments = joined.partition(" ")
+        instructions.append(Instruction(start + 1, keyword.upper(), arguments.strip()))
+    return instructions
+
+
+def compare(previous, current):
+    """
+    Compare a new render with the previous one and predict the layer cache.
+
+    Returns a dict with:
+     - status: "new" without a previous render, "unchanged" if both are byte
+       identical, "equivalent" if only comments or formatting outside of
+       instructions changed, "changed" otherwise
+     - rebuild: False when every layer is expected to come from the cache
+     - first_invalidated: index, line and text of the first instruction whose
+       layer can't come from the cache, None if there is none
+     - first_context_instruction: index of the first ADD/COPY before it. Its
+       cache also depends on the build context, so it may be invalidated by
+       changed files even if the Dockerfile didn't change there.
+
+    Instructions are compared in order and a changed base stage is assumed to
+    invalidate everything after it, which is conservative for multi stage builds.
+    """
+    new = parse_instructions(current)
+    report = {
+        "status": "changed",
+        "rebuild": True,
+        "instructions": len(new),
+        "first_invalidated": None,
+        "first_context_instruction": None,
+    }
+
+    if previous is None:
+        report["status"] = "new"
+        invalidated = 0 if new else None
+    elif previous == current:
+        report["status"] = "unchanged"
+        invalidated = None
+    else:
+        old = parse_instructions(previous)
+        invalidated = None
+        for index, instruction in enumerate(new):
+            if index >= len(old) or old[index] != instruction:
+                invalidated = index
+                break
+        if invalidated is None and len(old) == len(new):
+            report["status"] = "equivalent"
+
+    checked = new if invalidated is None else new[:invalidated]
+    for index, instruction in enumerate(checked):
+        if instruction.keyword in CONTEXT_INSTRUCTIONS:
+            report["first_context_instruction"] = index
+            break
+
+    if invalidated is None:
+        report["rebuild"] = False
+    else:
+        instruction = new[invalidated]
+        report["first_invalidated"] = {
+            "index": invalidated,
+            "line": instruction.lineno,
+            "instruction": str(instruction),
+        }
+    return report
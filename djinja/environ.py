@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+""" Lazy view of environment variables for templates """
+
+import os
+import re
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from djinja import FileProcessingError
+
+_dotenv_line = re.compile(r"^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_.]*)\s*=\s*(.*?)\s*$")
+_dotenv_escapes = {"n": "\n", "r": "\r", "t": "\t", '"': '"', "\\": "\\", "$": "$"}
+
+
+def parse_dotenv(text):
+    """
+    Parse dotenv formatted text into a dict.
+
+    Supports comments, "export" prefixes, single quoted values taken as they
+    are and double quoted values with backslash escapes.
+    """
+    result = {}
+    for line in text.splitlines():
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        match = _dotenv_line.match(line)
+        if match is None:
+            raise ValueError("invalid line in env file: {0}".format(line))
+
+        key, value = match.groups()
+        if len(value) > 1 and value[0] == value[-1] == "'":
+            value = value[1:-1]
+        elif len(value) > 1 and value[0] == value[-1] == '"':
+            value = re.sub(r"\\(.)", lambda m: _dotenv_escapes.get(m.group(1), m.group(0)), value[1:-1])
+        else:
+            # Unquoted values end at an inline comment
+            value = value.split(" #", 1)[0].rstrip()
+        result[key] = value
+    return result
+
+
+class LazyEnviron(Mapping):
+    """
+    Read only mapping over environment variables.
+
+    Variables are looked up in os.environ when a template accesses them,
+    nothing is copied up front. Env files are parsed on first access and
+    provide defaults for variables not set in the process environment. With
+    a prefix only variables starting with it are visible, with the prefix
+    stripped from their names.
+    """
+
+    def __init__(self, prefix="", env_files=(), environ=None):
+        self.prefix = prefix or ""
+        self.env_files = list(env_files)
+        self.environ = os.environ if environ is None else environ
+        self._file_vars = None
+
+    @property
+    def file_vars(self):
+        if self._file_vars is None:
+            file_vars = {}
+            for env_file in self.env_files:
+                try:
+                    with open(env_file, "r") as stream:
+                        file_vars.update(parse_dotenv(stream.read()))
+                except (OSError, IOError, ValueError) as e:
+                    raise FileProcessingError(e, env_file)
+            self._file_vars = file_vars
+        return self._file_vars
+
+    def __getitem__(self, key):
+        name = self.prefix + key
+        if name in self.environ:
+            return self.environ[name]
+        if self.env_files:
+            return self.file_vars[name]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        name = self.prefix + key
+        return name in self.environ or (bool(self.env_files) and name in self.file_vars)
+
+    def _names(self):
+        names = set(self.environ)
+        if self.env_files:
+            names.update(self.file_vars)
+        return sorted(n for n in names if n.startswith(self.prefix))
+
+    def __iter__(self):
+        for name in self._names():
+            yield name[len(self.prefix):]
+
+    def __len__(self):
+        return len(self._names())
+
+    def __repr__(self):
+        return "<LazyEnviron prefix={0!r}>".format(self.prefix)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+""" Jinja extensions registered by dj in every template environment """
+
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from jinja2 import nodes
+from jinja2.exceptions import TemplateRuntimeError
+from jinja2.ext import Extension
+
+from djinja.limits import current_budget
+
+Log = logging.getLogger(__name__)
+
+# Context key holding the mapping named outputs are collected in
+OUTPUTS_KEY = "_dj_outputs"
+
+
+class FragmentCache(object):
+    """
+    Store for rendered template fragments.
+
+    Fragments are kept in memory for the lifetime of the process and, if a
+    directory is given, also on disk so they survive between runs.
+    """
+
+    def __init__(self, directory=None, ttl=None, max_entries=None):
+        """
+        :param directory: Directory to persist fragments in, None keeps them in memory only.
+        :param ttl: Seconds a fragment stays valid, None never expires.
+        :param max_entries: Number of fragments kept in memory, least recently used are dropped first.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(parts):
+        """
+        Build a cache key from the key and vary_on values of a cache block.
+        Values must be JSON serializable so keys are the same in every run.
+        """
+        try:
+            return json.dumps(parts, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            raise TemplateRuntimeError("cache key and vary_on values must be JSON serializable: {0}".format(e))
+
+    def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires is None or expires > now:
+                self.entries.pop(key)
+                self.entries[key] = entry
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        value, created = self._get_from_disk(key, now)
+        if value is not None:
+            self.disk_hits += 1
+            # Keep the expiry of the fragment on disk
+            self._store(key, value, created)
+        return value
+
+    def set(self, key, value):
+        now = time.time()
+        self._store(key, value, now)
+        self._set_on_disk(key, value)
+
+    def fetch(self, parts, render):
+        """
+        Return cached fragment for given key parts or render and store it.
+        """
+        key = self.make_key(parts)
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+            value = render()
+            self.set(key, value)
+        return value
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+        }
+
+    def _store(self, key, value, created):
+        self.entries.pop(key, None)
+        self.entries[key] = (created + self.ttl if self.ttl is not None else None, value)
+        if self.max_entries is not None:
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _get_from_disk(self, key, now):
+        """
+        Return the value of a fragment on disk and when it was stored, the
+        value is None if there is no valid fragment.
+        """
+        if self.directory is None:
+            return None, None
+
+        path = self._path(key)
+        try:
+            created = os.path.getmtime(path)
+            if self.ttl is not None and created + self.ttl <= now:
+                return None, None
+            with open(path, "r") as stream:
+                data = json.load(stream)
+        except (OSError, IOError, ValueError):
+            return None, None
+
+        # Guard against hash collisions
+        if data.get("key") != key:
+            return None, None
+        return data.get("value"), created
+
+    def _set_on_disk(self, key, value):
+        if self.directory is None:
+            return
+
+        path = self._path(key)
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp_path, "w") as stream:
+                json.dump({"key": key, "value": value}, stream)
+            os.rename(tmp_path, path)
+        except (OSError, IOError) as e:
+            # Disk cache is best effort, the fragment is still cached in memory
+            Log.warning("Unable to write fragment cache file %s: %s", path, e)
+
+
+# Fragment caches shared by all environments created within the process
+_fragment_caches = {}
+
+
+def get_fragment_cache(directory=None, ttl=None, max_entries=None):
+    """
+    Return the process wide fragment cache for given settings.
+    """
+    settings = (directory, ttl, max_entries)
+    if settings not in _fragment_caches:
+        _fragment_caches[settings] = FragmentCache(directory, ttl, max_entries)
+    return _fragment_caches[settings]
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds a cache tag that memoizes the rendered output of its body:
+
+        {% cache "packages", OS %}
+        RUN apt-get install -y {{ packages|sort|join(" ") }}
+        {% endcache %}
+
+    The first argument is the explicit key of the fragment, any following
+    arguments are values the fragment varies on. A digest of the body is
+    part of the key, so an edited body renders anew. The cache in use is
+    `environment.fragment_cache`. Named outputs written inside the block are
+    cached with the fragment and written again when it is reused.
+    """
+    tags = set(["cache"])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=get_fragment_cache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        # Editing the body must not reuse fragments rendered by the old one
+        digest = hashlib.sha1(repr(body).encode("utf-8")).hexdigest()
+        parts.insert(0, nodes.Const(digest))
+        call = self.call_method("_cache_fragment", [nodes.List(parts), nodes.ContextReference()])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache_fragment(self, parts, context, caller):
+        outputs = context.get(OUTPUTS_KEY)
+        rendered = []
+
+        def render():
+            before = dict(outputs or {})
+            value = caller()
+            written = OrderedDict()
+            for path, content in (outputs or {}).items():
+                if len(content) > len(before.get(path, u"")):
+                    written[path] = content[len(before.get(path, u"")):]
+            rendered.append(True)
+            return {"output": value, "outputs": written}
+
+        fragment = self.environment.fragment_cache.fetch(parts, render)
+        if not rendered:
+            # Served from the cache, named outputs of the body are written again
+            for path, content in fragment["outputs"].items():
+                _append_output(outputs, path, content)
+        return fragment["output"]
+
+
+def _append_output(outputs, path, content):
+    """
+    Append content to a named output, counted against the render's output limit.
+    """
+    budget = current_budget()
+    if budget is not None:
+        budget.add_output(len(content))
+    outputs[path] = outputs.get(path, u"") + content
+
+
+class OutputExtension(Extension):
+    """
+    Adds an output tag that directs the rendered body to a named output file
+    instead of the main output:
+
+        {% output "entrypoint.sh" %}
+        #!/bin/sh
+        exec {{ command }}
+        {% endoutput %}
+
+    Paths are relative to the output directory. Content written to the same
+    path more than once is appended.
+    """
+    tags = set(["output"])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        path = parser.parse_expression()
+        body = parser.parse_statements(["name:endoutput"], drop_needle=True)
+        call = self.call_method("_write_output", [path, nodes.ContextReference()])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _write_output(self, path, context, caller):
+        outputs = context.get(OUTPUTS_KEY)
+        if outputs is None:
+            raise TemplateRuntimeError("named outputs are not supported in this render")
+
+        normalized = os.path.normpath(path)
+        if normalized == os.curdir:
+            raise TemplateRuntimeError("output path must name a file: {0!r}".format(path))
+        if os.path.isabs(normalized) or normalized.split(os.sep)[0] == os.pardir:
+            raise TemplateRuntimeError("output path must be inside the output directory: {0}".format(path))
+
+        _append_output(outputs, normalized, caller())
+        return u""
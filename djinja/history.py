@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+History of batch runs.
+
+Every batch run appends one JSON line with the compile and render durations
+and cache counters of each target. The history is used to schedule slow
+targets first and is summarized by dj stats.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from djinja import FileProcessingError
+
+# Runs kept in a history file, older runs are dropped
+MAX_RUNS = 50
+
+# Runs averaged to estimate how long a target takes
+RECENT_RUNS = 5
+
+
+@contextmanager
+def _locked(path):
+    """
+    Hold an exclusive lock on a lock file where file locks are available.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as stream:
+        fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
+
+
+class History(object):
+
+    def __init__(self, path, max_runs=MAX_RUNS):
+        """
+        :param path: JSON lines file with one record per run.
+        :param max_runs: Number of runs to keep.
+        """
+        self.path = path
+        self.max_runs = max_runs
+
+    def runs(self):
+        """
+        Return all recorded runs, oldest first. A missing file is an empty history.
+        """
+        runs = []
+        try:
+            with open(self.path, "r") as stream:
+                for line in stream:
+                    try:
+                        run = json.loads(line)
+                    except ValueError:
+                        # A run interrupted while writing, skip it
+                        continue
+                    if isinstance(run, dict) and isinstance(run.get("targets"), dict):
+                        runs.append(run)
+        except (OSError, IOError):
+            pass
+        return runs
+
+    def append(self, run):
+        """
+        Record a run and drop the oldest ones beyond max_runs.
+
+        The run is appended and the history trimmed under one file lock, so
+        batches sharing a history, like shards or parallel jobs using one
+        cache directory, don't drop each other's runs.
+        """
+        line = json.dumps(run, sort_keys=True) + "\n"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Trimming replaces the history file, so the lock is held on a separate file
+            with _locked(self.path + ".lock"):
+                with open(self.path, "a") as stream:
+                    stream.write(line)
+                self._trim()
+        except (OSError, IOError) as e:
+            raise FileProcessingError(e, self.path)
+
+    def trim(self):
+        """
+        Drop the oldest runs beyond max_runs, under the same lock as append.
+        """
+        try:
+            with _locked(self.path + ".lock"):
+                self._trim()
+        except (OSError, IOError) as e:
+            raise FileProcessingError(e, self.path)
+
+    def _trim(self):
+        """
+        The kept runs are written to a temporary file that replaces the
+        history, an interrupted trim leaves the history as it was.
+        """
+        with open(self.path, "r") as stream:
+            lines = stream.readlines()
+        if len(lines) <= self.max_runs:
+            return
+
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as stream:
+                stream.writelines(lines[-self.max_runs:])
+            os.rename(tmp_path, self.path)
+        except (OSError, IOError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def durations(self, last=RECENT_RUNS):
+        """
+        Return the average compile and render seconds per target over its
+        last successful runs.
+        """
+        samples = {}
+        for run in self.runs():
+            for name, target in run["targets"].items():
+                if target.get("ok"):
+                    samples.setdefault(name, []).append(_total(target))
+        return dict((name, sum(s[-last:]) / len(s[-last:])) for name, s in samples.items())
+
+
+def new_run(results, seconds, jobs=1, shard=None):
+    """
+    Build the history record of a batch run from render_target results.
+    """
+    return {
+        "time": int(time.time()),
+        "seconds": round(seconds, 4),
+        "jobs": jobs,
+        "shard": shard,
+        "targets": dict((r["name"], {
+            "ok": r["ok"],
+            "compile": round(r["timings"].get("compile", 0.0), 4),
+            "render": round(r["timings"].get("render", 0.0), 4),
+            "cache": r["cache"],
+        }) for r in results),
+    }
+
+
+def _total(target):
+    return target.get("compile", 0.0) + target.get("render", 0.0)
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def _ratio(hits, total):
+    return round(float(hits) / total, 4) if total else None
+
+
+def _trend(samples):
+    """
+    Relative change of the newer half of samples against the older half.
+    """
+    if len(samples) < 2:
+        return None
+    half = len(samples) // 2
+    old, new = _mean(samples[:half]), _mean(samples[-half:])
+    return round(new / old - 1, 4) if old else None
+
+
+def summarize(runs, top=10):
+    """
+    Summarize runs for dj stats: the slowest targets with their trends,
+    cache hit ratios and totals of the most recent runs.
+    """
+    samples = {}
+    counters = {"hits": 0, "disk_hits": 0, "misses": 0, "compile_hits": 0, "compile_misses": 0}
+    for run in runs:
+        for name, target in run["targets"].items():
+            entry = samples.setdefault(name, {"compile": [], "render": [], "failed": 0, "hits": 0, "lookups": 0})
+            cache = target.get("cache") or {}
+            for key in counters:
+                counters[key] += cache.get(key, 0)
+            entry["hits"] += cache.get("hits", 0) + cache.get("disk_hits", 0)
+            entry["lookups"] += cache.get("hits", 0) + cache.get("disk_hits", 0) + cache.get("misses", 0)
+            if not target.get("ok"):
+                entry["failed"] += 1
+                continue
+            entry["compile"].append(target.get("compile", 0.0))
+            entry["render"].append(target.get("render", 0.0))
+
+    targets = []
+    for name, entry in samples.items():
+        totals = [c + r for c, r in zip(entry["compile"], entry["render"])]
+        targets.append({
+            "name": name,
+            "runs": len(totals),
+            "failed": entry["failed"],
+            "compile": round(_mean(entry["compile"]) or 0.0, 4),
+            "render": round(_mean(entry["render"]) or 0.0, 4),
+            "seconds": round(_mean(totals) or 0.0, 4),
+            "last": round(totals[-1], 4) if totals else None,
+            "trend": _trend(totals),
+            "cache_hit_ratio": _ratio(entry["hits"], entry["lookups"]),
+        })
+    targets.sort(key=lambda t: (-t["seconds"], t["name"]))
+
+    fragment_hits = counters["hits"] + counters["disk_hits"]
+    compiles = counters["compile_hits"] + counters["compile_misses"]
+    return {
+        "runs": len(runs),
+        "slowest": targets[:top],
+        "cache": {
+            "fragment_hit_ratio": _ratio(fragment_hits, fragment_hits + counters["misses"]),
+            "fragment_disk_hits": counters["disk_hits"],
+            "compile_hit_ratio": _ratio(counters["compile_hits"], compiles),
+        },
+        "recent": [{
+            "time": run.get("time"),
+            "seconds": run.get("seconds"),
+            "jobs": run.get("jobs"),
+            "targets": len(run["targets"]),
+            "failed": sum(1 for t in run["targets"].values() if not t.get("ok")),
+        } for run in runs[-RECENT_RUNS:]],
+    }
+
+
+def _percent(value):
+    return "-" if value is None else "{0:+.0%}".format(value)
+
+
+def format_summary(summary):
+    """
+    Render a summary as plain text lines.
+    """
+    lines = ["{0} runs recorded".format(summary["runs"]), ""]
+    lines.append("{0:<30} {1:>8} {2:>8} {3:>8} {4:>8} {5:>7} {6:>6}".format(
+        "slowest targets", "compile", "render", "avg", "last", "trend", "cache"))
+    for t in summary["slowest"]:
+        lines.append("{0:<30} {1:>8.3f} {2:>8.3f} {3:>8.3f} {4:>8} {5:>7} {6:>6}".format(
+            t["name"][-30:], t["compile"], t["render"], t["seconds"],
+            "-" if t["last"] is None else "{0:.3f}".format(t["last"]),
+            _percent(t["trend"]),
+            "-" if t["cache_hit_ratio"] is None else "{0:.0%}".format(t["cache_hit_ratio"])))
+
+    cache = summary["cache"]
+    lines.append("")
+    lines.append("fragment cache hit ratio: {0} ({1} from disk)".format(
+        "-" if cache["fragment_hit_ratio"] is None else "{0:.0%}".format(cache["fragment_hit_ratio"]),
+        cache["fragment_disk_hits"]))
+    lines.append("compile cache hit ratio: {0}".format(
+        "-" if cache["compile_hit_ratio"] is None else "{0:.0%}".format(cache["compile_hit_ratio"])))
+
+    lines.append("")
+    lines.append("recent runs:")
+    for run in summary["recent"]:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run["time"])) if run["time"] else "-"
+        lines.append("  {0}  {1:>8.3f}s  {2} targets, {3} failed, {4} jobs".format(
+            when, run["seconds"] or 0.0, run["targets"], run["failed"], run["jobs"]))
+    return lines
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""
+Resource limits for template rendering.
+
+Limits are checked while the template runs: on every call, every loop
+iteration and every chunk of output, so a runaway template fails fast
+instead of stalling the process. A single long running python function
+called from a template can't be interrupted, so operations that build
+large values in one step, like repetition, integer powers and string
+building filters, are checked against the limits before they run.
+"""
+
+import functools
+import math
+import numbers
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from jinja2 import nodes
+from jinja2.defaults import DEFAULT_NAMESPACE
+from jinja2.runtime import LoopContext
+from jinja2.sandbox import SandboxedEnvironment
+
+from djinja import RenderLimitError
+
+# Block assignments, {% set x %}...{% endset %}, and whether they take a filter
+# depend on the jinja version
+_ASSIGN_BLOCK = getattr(nodes, "AssignBlock", None)
+_ASSIGN_BLOCK_FILTERS = _ASSIGN_BLOCK is not None and "filter" in _ASSIGN_BLOCK.fields
+
+# Digits a ** result may have when no output limit is set. Larger powers can
+# block the process for longer than any timeout, which is only checked between calls.
+MAX_POWER_DIGITS = 100000
+
+# Width and precision of % format specifiers
+_format_widths = re.compile(r"%(?:\([^)]*\))?[-+ #0]*(\d*)(?:\.(\d+))?")
+
+
+def _arg(args, kwargs, position, name, default):
+    return args[position] if len(args) > position else kwargs.get(name, default)
+
+
+def _estimate_center(args, kwargs):
+    return max(len(args[0]), _arg(args, kwargs, 1, "width", 80))
+
+
+def _estimate_indent(args, kwargs):
+    width = _arg(args, kwargs, 1, "width", 4)
+    if not isinstance(width, int):
+        width = len(width)
+    return len(args[0]) + width * (args[0].count("\n") + 1)
+
+
+def _estimate_replace(args, kwargs):
+    s, old, new = args[0], args[1], args[2]
+    count = s.count(old) if old else len(s) + 1
+    limit = _arg(args, kwargs, 3, "count", None)
+    if limit is not None and limit >= 0:
+        count = min(count, limit)
+    return len(s) + count * max(0, len(new) - len(old))
+
+
+def _estimate_format(args, kwargs):
+    widths = [int(n) for m in _format_widths.finditer(args[0]) for n in m.groups() if n]
+    return len(args[0]) + sum(widths)
+
+
+# Filters that build strings, with estimates of the result size where it can
+# be known before the string is built. join and wordwrap results are bounded
+# by their input and only checked afterwards.
+STRING_FILTERS = {
+    "center": _estimate_center,
+    "indent": _estimate_indent,
+    "replace": _estimate_replace,
+    "format": _estimate_format,
+    "join": None,
+    "wordwrap": None,
+}
+
+
+def _passes_argument(func):
+    """
+    True if jinja passes the context, eval context or environment to func.
+    """
+    return bool(getattr(func, "jinja_pass_arg", None) or getattr(func, "contextfilter", False)
+                or getattr(func, "evalcontextfilter", False) or getattr(func, "environmentfilter", False))
+
+
+def _limited_filter(func, estimate):
+    """
+    Wrap a string building filter to refuse results larger than the output limit.
+    """
+    skip = 1 if _passes_argument(func) else 0
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_current, "compiling", False):
+            # Jinja evaluates filters with constant arguments while compiling,
+            # outside of any render. Failing here defers them to render time.
+            raise RenderLimitError("not evaluated while compiling")
+
+        budget = current_budget()
+        if budget is None or budget.limits.max_output is None:
+            return func(*args, **kwargs)
+
+        max_output = budget.limits.max_output
+        if estimate is not None:
+            try:
+                size = estimate(args[skip:], kwargs)
+            except (TypeError, ValueError, IndexError, AttributeError):
+                # Let the filter report invalid arguments itself
+                size = 0
+            if size > max_output:
+                raise RenderLimitError("{0} result exceeds {1} characters".format(func.__name__, max_output))
+
+        result = func(*args, **kwargs)
+        if hasattr(result, "__len__") and len(result) > max_output:
+            raise RenderLimitError("{0} result exceeds {1} characters".format(func.__name__, max_output))
+        return result
+    return wrapper
+
+
+# Budget of the render running in the current thread
+_current = threading.local()
+
+
+def current_budget():
+    return getattr(_current, "budget", None)
+
+
+class RenderBudget(object):
+    """
+    Resources used by one render, checked against its RenderLimits.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.deadline = time.time() + limits.timeout if limits.timeout is not None else None
+        self.output = 0
+        self.iterations = 0
+        self.depth = 0
+
+    def check_time(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise RenderLimitError("render timed out after {0} seconds".format(self.limits.timeout))
+
+    def add_output(self, size):
+        self.output += size
+        if self.limits.max_output is not None and self.output > self.limits.max_output:
+            raise RenderLimitError("output exceeds {0} characters".format(self.limits.max_output))
+
+    def add_iteration(self):
+        self.iterations += 1
+        if self.limits.max_loop is not None and self.iterations > self.limits.max_loop:
+            raise RenderLimitError("more than {0} loop iterations".format(self.limits.max_loop))
+        self.check_time()
+
+    def enter(self):
+        self.check_time()
+        self.depth += 1
+        if self.limits.max_depth is not None and self.depth > self.limits.max_depth:
+            raise RenderLimitError("call depth exceeds {0}".format(self.limits.max_depth))
+
+    def leave(self):
+        self.depth -= 1
+
+
+class RenderLimits(object):
+    """
+    Limits applied to every render, None disables a limit.
+    """
+
+    def __init__(self, timeout=None, max_output=None, max_loop=None, max_depth=None):
+        """
+        :param timeout: Wall clock seconds a render may take.
+        :param max_output: Characters a render may produce.
+        :param max_loop: Loop iterations a render may run, summed over all loops.
+        :param max_depth: Depth of nested calls, e.g. recursive macros.
+        """
+        self.timeout = timeout
+        self.max_output = max_output
+        self.max_loop = max_loop
+        self.max_depth = max_depth
+
+    @contextmanager
+    def active(self):
+        """
+        Apply the limits to renders within this block in the current thread.
+        """
+        previous = current_budget()
+        _current.budget = RenderBudget(self)
+        try:
+            yield _current.budget
+        finally:
+            _current.budget = previous
+
+    def render(self, chunks):
+        """
+        Join output chunks of a render while enforcing the limits.
+        """
+        with self.active() as budget:
+            out = []
+            for chunk in chunks:
+                budget.add_output(len(chunk))
+                budget.check_time()
+                out.append(chunk)
+            return u"".join(out)
+
+
+class LimitedEnvironment(SandboxedEnvironment):
+    """
+    Environment that enforces the active render limits.
+
+    It is built on the sandbox so every call and binary operator goes through
+    the environment. Unless sandbox is set, access to attributes and callables
+    isn't restricted.
+    """
+    intercepted_binops = frozenset(["*", "**"])
+
+    def __init__(self, sandbox=False, **options):
+        self.sandbox = sandbox
+        super(LimitedEnvironment, self).__init__(**options)
+        if not sandbox:
+            self.globals["range"] = DEFAULT_NAMESPACE["range"]
+        self.filters["_limit_output"] = self.guard_output
+        for name, estimate in STRING_FILTERS.items():
+            if name in self.filters:
+                self.filters[name] = _limited_filter(self.filters[name], estimate)
+
+    def is_safe_attribute(self, obj, attr, value):
+        return not self.sandbox or super(LimitedEnvironment, self).is_safe_attribute(obj, attr, value)
+
+    def is_safe_callable(self, obj):
+        return not self.sandbox or super(LimitedEnvironment, self).is_safe_callable(obj)
+
+    def _parse(self, source, name, filename):
+        tree = super(LimitedEnvironment, self)._parse(source, name, filename)
+        # Route every loop through guard_loop to count its iterations
+        for node in tree.find_all(nodes.For):
+            node.iter = nodes.Call(nodes.EnvironmentAttribute("guard_loop"), [node.iter], [], None, None,
+                                   lineno=node.lineno)
+        # Count content captured by {% set x %} blocks, it never reaches the output directly
+        if _ASSIGN_BLOCK_FILTERS:
+            for node in tree.find_all(_ASSIGN_BLOCK):
+                node.filter = nodes.Filter(node.filter, "_limit_output", [], [], None, None, lineno=node.lineno)
+        return tree
+
+    def _generate(self, *args, **kwargs):
+        _current.compiling = True
+        try:
+            return super(LimitedEnvironment, self)._generate(*args, **kwargs)
+        finally:
+            _current.compiling = False
+
+    def guard_output(self, value):
+        budget = current_budget()
+        if budget is not None:
+            budget.add_output(len(value))
+        return value
+
+    def guard_loop(self, iterable):
+        budget = current_budget()
+        if budget is None:
+            return iterable
+        return self._guarded(iterable, budget)
+
+    @staticmethod
+    def _guarded(iterable, budget):
+        for item in iterable:
+            budget.add_iteration()
+            yield item
+
+    def call(__self, __context, __obj, *args, **kwargs):
+        budget = current_budget()
+        if budget is None:
+            return SandboxedEnvironment.call(__self, __context, __obj, *args, **kwargs)
+
+        if isinstance(__obj, LoopContext) and args:
+            # loop(...) in a recursive for loop iterates without passing For.iter
+            args = (__self.guard_loop(args[0]),) + args[1:]
+        budget.enter()
+        try:
+            return SandboxedEnvironment.call(__self, __context, __obj, *args, **kwargs)
+        finally:
+            budget.leave()
+
+    def call_binop(self, context, operator, left, right):
+        budget = current_budget()
+        if budget is not None and budget.limits.max_output is not None and operator == "*":
+            # Refuse to build huge repeated strings or lists in one operation
+            for seq, times in ((left, right), (right, left)):
+                if hasattr(seq, "__len__") and isinstance(times, int) and len(seq) * times > budget.limits.max_output:
+                    raise RenderLimitError("repetition exceeds {0} items".format(budget.limits.max_output))
+        if budget is not None and operator == "**":
+            self._check_power(budget, left, right)
+        return super(LimitedEnvironment, self).call_binop(context, operator, left, right)
+
+    @staticmethod
+    def _check_power(budget, base, exponent):
+        """
+        Refuse integer powers with more digits than the output limit allows,
+        or MAX_POWER_DIGITS without one. Computing them can't be interrupted.
+        """
+        if isinstance(base, bool) or isinstance(exponent, bool):
+            return
+        integral = isinstance(base, numbers.Integral) and isinstance(exponent, numbers.Integral)
+        if not integral or exponent <= 0 or abs(base) < 2:
+            return
+        limit = budget.limits.max_output if budget.limits.max_output is not None else MAX_POWER_DIGITS
+        if exponent * math.log10(abs(base)) > limit:
+            raise RenderLimitError("power exceeds {0} digits".format(limit))
@@ -2,15 +2,33 @@
 
 import os
 import sys
+import json
+import time
+import hashlib
 import logging
+import functools
+from collections import OrderedDict
 
 from jinja2 import Environment
+from jinja2.utils import LRUCache
 
-from djinja import contrib, FileProcessingError, ExitError
-from djinja.conftree import ConfTree
+from djinja import contrib, FileProcessingError, ExitError, RenderLimitError
+from djinja.batch import assign_shards, load_targets, load_timings, parse_shard, run_targets, save_timings, schedule
+from djinja.buildcontext import open_socket, stream_build_context
+from djinja.check import TemplateChecker, find_templates, run_checks
+from djinja.conftree import ConfTree, ContextChain
+from djinja.dockerfile import compare
+from djinja.environ import LazyEnviron
+from djinja.history import History, format_summary, new_run, summarize
+from djinja.extensions import FragmentCacheExtension, OutputExtension, OUTPUTS_KEY, get_fragment_cache
+from djinja.limits import LimitedEnvironment, RenderLimits
+from djinja.partial import specialize
 
 Log = logging.getLogger(__name__)
 
+# Compiled templates kept by a long running process, least recently used are dropped first
+TEMPLATE_CACHE_SIZE = 400
+
 
 class Core(object):
 
@@ -24,6 +42,16 @@ class Core(object):
             "globals": {},
             "filters": {},
         }
+        self.fragment_cache = None
+        self.render_limits = None
+        # Layer cache predictions of all targets rendered, see get_layer_report
+        self.layer_reports = []
+        # Render durations of batch targets in seconds and the (index, count) shard rendered
+        self.target_timings = {}
+        self.shard = None
+        # Compiled and specialized templates, see compile_template
+        self.templates = LRUCache(TEMPLATE_CACHE_SIZE)
+        self.compile_stats = {"compile_hits": 0, "compile_misses": 0}
         Log.debug("Cli args: %s", self.args)
 
         self.default_config_files = [
@@ -38,7 +66,7 @@ class Core(object):
         # Load all config files into unified config tree, don't fail on load since
         # default config files might not exist.
         Log.debug("Building config...")
-        self.config = ConfTree()
+        self.config = ConfTree(lazy=self.args.get("--lazy-config", False))
         self.config.load_config_files(self.default_config_files, onload_fail=False)
         Log.debug("Config building is done")
 
@@ -47,11 +75,11 @@ class Core(object):
         Parse all variables inputed from cli and add them to global config
         """
         _vars = {}
-        for var in self.args.get("--env", []):
-            s = var.split("=")
-            if len(s) != 2 or (len(s[0]) == 0 or len(s[1]) == 0):
+        for var in self.args.get("--env") or []:
+            key, sep, value = var.partition("=")
+            if not sep or not key or not value:
                 raise Exception("var '{0}' is not of format 'key=value'".format(var))
-            _vars[s[0]] = s[1]
+            _vars[key] = value
         self.config.merge_data_tree(_vars)
 
     def load_user_specefied_config_files(self):
@@ -113,36 +141,501 @@ class Core(object):
             Log.error("Couldn't process - %s", e.args[1])
             Log.error("%s", e.args[0])
             raise ExitError("dockerfile not loaded")
+        except RenderLimitError as e:
+            Log.error("Render limit exceeded - %s", self.args["--dockerfile"])
+            Log.error("%s", e)
+            raise ExitError("render limit exceeded")
 
     def process_dockerfile(self):
         """
         Read source dockerfile --> Render with jinja --> Write to outfile
         """
         source_dockerfile = self.args["--dockerfile"]
-        outputfile = self.args["--outfile"]
+
+        if self.args.get("--build-context") and self.args.get("--outdir"):
+            Log.error("--build-context streams a tar archive and can't be used with --outdir")
+            raise ExitError("invalid arguments")
+        if self.args.get("--socket") and not self.args.get("--build-context"):
+            Log.error("--socket requires --build-context")
+            raise ExitError("invalid arguments")
 
         try:
-            with open(source_dockerfile, "r") as stream:
-                Log.info("Reading source file...")
-                environment = self.get_template_environment()
-                template = environment.from_string(stream.read())
+            Log.info("Reading source file...")
+            if source_dockerfile == "-":
+                source = sys.stdin.read()
+                mtime = time.time()
+            else:
+                with open(source_dockerfile, "r") as stream:
+                    source = stream.read()
+                mtime = os.path.getmtime(source_dockerfile)
         except (OSError, IOError) as e:
             raise FileProcessingError(e, source_dockerfile)
 
+        environment = self.get_template_environment()
+        template = self.compile_template(environment, source)
+
         context = self.config.get_tree()
         Log.debug("context: %s", context)
 
         Log.info("rendering Dockerfile...")
-        out_data = template.render(**context)
+        outputs = OrderedDict()
+        out_data = self.render_template(template, context, outputs)
 
         Log.debug("Data to be written to the output file\n*****\n%s*****", out_data)
 
+        if self.args.get("--build-context"):
+            self.send_build_context(out_data, outputs, mtime)
+            return
+
+        paths = self.get_output_paths(outputs)
+        report = paths[0][0] != "-" and self.args.get("--layer-report")
+        previous = self.read_previous(paths[0][0]) if report else None
+        self.write_outputs(out_data, outputs, paths)
+        if report:
+            self.layer_reports.append(self.get_layer_report(paths[0][0], paths[0][0], previous, out_data))
+        self.write_layer_report()
+
+    def handle_batch(self):
+        """
+        Render every target of the targets file given on cli. A failing target
+        is reported and the remaining targets are rendered as usual.
+        """
+        try:
+            targets = load_targets(self.args["TARGETS"])
+            timings = load_timings(self.args.get("--timings") or [])
+        except FileProcessingError as e:
+            Log.error("Couldn't load targets or timings - %s", e.args[1])
+            Log.error("%s", e.args[0])
+            raise ExitError("targets not loaded")
+
+        if self.args.get("--shard"):
+            try:
+                self.shard = parse_shard(self.args["--shard"])
+            except ValueError as e:
+                Log.error("%s", e)
+                raise ExitError("invalid argument")
+            index, count = self.shard
+            targets = assign_shards(targets, count, timings)[index - 1]
+            Log.info("Shard %s/%s renders %s targets", index, count, len(targets))
+
+        # Start the slowest targets first, results are reported in targets file order
+        history = self.get_history()
+        order = dict((t["name"], n) for n, t in enumerate(targets))
+        scheduled = schedule(targets, history.durations() if history is not None else {})
+        jobs = self.get_number_arg("--jobs", int) or 1
+
+        environment = self.get_template_environment()
+        start = time.time()
+        results = run_targets(functools.partial(self.render_target, environment), scheduled, jobs)
+        seconds = time.time() - start
+        results.sort(key=lambda r: order[r["name"]])
+
+        for result in results:
+            if result["report"] is not None:
+                self.layer_reports.append(result["report"])
+            if result["ok"]:
+                self.target_timings[result["name"]] = sum(result["timings"].values())
+        failed = [r["name"] for r in results if not r["ok"]]
+        self.write_layer_report()
+
+        if history is not None:
+            try:
+                history.append(new_run(results, seconds, jobs, self.args.get("--shard")))
+            except FileProcessingError as e:
+                Log.warning("Couldn't write history %s: %s", e.args[1], e.args[0])
+
+        if self.args.get("--save-timings"):
+            try:
+                save_timings(self.args["--save-timings"], self.target_timings)
+            except FileProcessingError as e:
+                Log.error("Couldn't write timings - %s", e.args[1])
+                Log.error("%s", e.args[0])
+                raise ExitError("timings not written")
+
+        Log.info("Rendered %s of %s targets", len(targets) - len(failed), len(targets))
+        if failed:
+            Log.error("Failed targets: %s", ", ".join(failed))
+            raise ExitError("batch failed")
+
+    def render_target(self, environment, target):
+        """
+        Render and write one target of a batch.
+
+        Returns a result with its layer report, compile and render durations
+        and cache counters. Results are plain data so targets can be rendered
+        in worker processes.
+        """
+        result = {"name": target["name"], "ok": False, "timings": {}, "report": None}
+        before = self.get_cache_counters()
+        try:
+            out_data, outputs = self.render_item(environment, target, result["timings"])
+            paths = self.get_output_paths(outputs, target["outfile"], target["outdir"], target["dockerfile"])
+            if self.args.get("--layer-report"):
+                previous = self.read_previous(paths[0][0])
+            self.write_outputs(out_data, outputs, paths)
+            result["ok"] = True
+        except Exception as e:
+            # One broken target must not stop the batch
+            Log.error("Target %s failed: %s", target["name"], e)
+            if self.args.get("--layer-report"):
+                result["report"] = {
+                    "name": target["name"],
+                    "status": "error",
+                    "rebuild": True,
+                    "error": "{0}: {1}".format(type(e).__name__, e),
+                }
+
+        after = self.get_cache_counters()
+        result["cache"] = dict((k, after[k] - before[k]) for k in after)
+        if result["ok"] and self.args.get("--layer-report"):
+            result["report"] = self.get_layer_report(target["name"], paths[0][0], previous, out_data)
+            result["report"]["seconds"] = round(sum(result["timings"].values()), 4)
+        return result
+
+    def get_cache_counters(self):
+        """
+        Fragment and compile cache counters of this process.
+        """
+        counters = dict(self.compile_stats)
+        if self.fragment_cache is not None:
+            stats = self.fragment_cache.stats()
+            counters.update((k, stats[k]) for k in ("hits", "disk_hits", "misses"))
+        return counters
+
+    def get_history(self):
+        """
+        History of batch runs from --history, stored in --cache-dir by default.
+        None if neither is given.
+        """
+        path = self.args.get("--history")
+        if not path and self.args.get("--cache-dir"):
+            path = os.path.join(self.args["--cache-dir"], "history.jsonl")
+        return History(path) if path else None
+
+    def handle_stats(self):
+        """
+        Print the slowest targets, cache hit ratios and recent runs recorded
+        in the history of batch runs.
+        """
+        history = self.get_history()
+        if history is None:
+            Log.error("No history to read, use --history or --cache-dir")
+            raise ExitError("no history")
+
+        runs = history.runs()
+        if not runs:
+            Log.warning("No runs recorded in %s", history.path)
+        summary = summarize(runs, self.get_number_arg("--top", int) or 10)
+        if self.args.get("--json"):
+            sys.stdout.write(json.dumps(summary, indent=2, sort_keys=True) + "\n")
+        else:
+            sys.stdout.write("\n".join(format_summary(summary)) + "\n")
+        sys.stdout.flush()
+
+    @staticmethod
+    def read_previous(path):
+        """
+        Content of a previous render at path, None if there is none.
+        """
+        if path == "-":
+            return None
+        try:
+            with open(path, "r") as stream:
+                return stream.read()
+        except (OSError, IOError):
+            return None
+
+    @staticmethod
+    def get_layer_report(name, path, previous, out_data):
+        """
+        Predict which layers of a target the new render invalidates.
+        """
+        report = compare(previous, out_data)
+        report["name"] = name
+        report["outfile"] = path
+        return report
+
+    def write_layer_report(self):
+        """
+        Write layer cache predictions as JSON to the --layer-report file.
+        """
+        report_file = self.args.get("--layer-report")
+        if not report_file:
+            return
+
+        report = {"targets": self.layer_reports}
+        if self.shard:
+            report["shard"] = {"index": self.shard[0], "count": self.shard[1]}
+        data = json.dumps(report, indent=2, sort_keys=True) + "\n"
+        if report_file == "-":
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
         try:
-            with open(outputfile, "w") as stream:
-                Log.info("Writing to outfile...")
-                stream.write(out_data)
+            with open(report_file, "w") as stream:
+                stream.write(data)
         except (OSError, IOError) as e:
-            raise FileProcessingError(e, outputfile)
+            Log.error("Couldn't write layer report - %s", report_file)
+            Log.error("%s", e)
+            raise ExitError("layer report not written")
+
+    def handle_check(self):
+        """
+        Validate all templates given on cli without rendering them and print
+        one line per issue found.
+        """
+        environment = self.get_template_environment()
+        checker = TemplateChecker(
+            environment,
+            self.config.get_tree(),
+            self.args.get("--cache-dir"),
+            self.get_check_fingerprint(environment),
+        )
+
+        paths = find_templates(self.args.get("PATH") or [])
+        Log.info("Checking %s templates...", len(paths))
+        issues = run_checks(checker, paths, self.get_number_arg("--jobs", int))
+        for issue in issues:
+            sys.stdout.write(issue + "\n")
+        sys.stdout.flush()
+
+        if issues:
+            Log.error("%s issues found in %s templates", len(issues), len(paths))
+            raise ExitError("check failed")
+
+    def get_check_fingerprint(self, environment):
+        """
+        Identify everything besides the template source that check results
+        depend on: known names and the state of all config files.
+        """
+        parts = [
+            sorted(environment.globals),
+            sorted(environment.filters),
+            sorted(environment.tests),
+            sorted(str(k) for k in self.config.get_tree()),
+        ]
+        for config_file in self.default_config_files + list(self.args.get("--config") or []):
+            try:
+                st = os.stat(config_file)
+            except OSError:
+                continue
+            parts.append([config_file, st.st_size, st.st_mtime])
+        return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def handle_stream(self, instream, outstream):
+        """
+        Render a stream of templates in one process.
+
+        Every line read from instream is a JSON object describing one render:
+
+            {"id": 1, "template": "FROM {{ OS }}", "env": {"OS": "debian"}}
+
+        "dockerfile" can be given instead of "template" to read the template
+        from a file, "env" holds variables overriding the config for this
+        render only. For every request one JSON line is written in order:
+
+            {"id": 1, "output": "FROM debian", "outputs": {}}
+
+        A request that fails gets an "error" message instead, following
+        requests are rendered as usual.
+        """
+        environment = self.get_template_environment()
+        count = 0
+        for line in iter(instream.readline, ""):
+            if not line.strip():
+                continue
+            response = self.render_stream_item(environment, line)
+            outstream.write(json.dumps(response) + "\n")
+            outstream.flush()
+            count += 1
+        Log.info("Rendered %s stream items", count)
+
+    def render_stream_item(self, environment, line):
+        """
+        Render one request of the template stream and return the response.
+        """
+        response = {"id": None}
+        try:
+            item = json.loads(line)
+            if not isinstance(item, dict):
+                raise ValueError("stream item must be a JSON object")
+            response["id"] = item.get("id")
+            response["output"], response["outputs"] = self.render_item(environment, item)
+        except Exception as e:
+            # One broken request must not stop the stream
+            Log.error("Stream item %s failed: %s", response["id"], e)
+            response["error"] = "{0}: {1}".format(type(e).__name__, e)
+        return response
+
+    def render_item(self, environment, item, timings=None):
+        """
+        Render the template of a stream request or batch target.
+
+        :param item: Mapping with the template source ("template") or a path
+                     to it ("dockerfile") and "env" overrides for this render.
+        :param timings: Dict that receives the "compile" and "render" seconds.
+        :return: Tuple of the rendered output and the named outputs.
+        """
+        timings = {} if timings is None else timings
+        start = time.time()
+        if item.get("template") is not None:
+            source = item["template"]
+        else:
+            with open(item["dockerfile"], "r") as stream:
+                source = stream.read()
+
+        overrides = item.get("env") or {}
+        template = self.compile_template(environment, source, overrides)
+        timings["compile"] = time.time() - start
+
+        start = time.time()
+        outputs = OrderedDict()
+        context = ContextChain(overrides, self.config.get_tree())
+        out_data = self.render_template(template, context, outputs)
+        timings["render"] = time.time() - start
+        return out_data, outputs
+
+    def send_build_context(self, out_data, outputs, mtime):
+        """
+        Stream the rendered Dockerfile, named outputs and the files of the build
+        context as one tar archive to the outfile or socket.
+        """
+        context_dir = self.args["--build-context"]
+        address = self.args.get("--socket")
+        destination = address or self.args["--outfile"]
+
+        rendered = OrderedDict([("Dockerfile", out_data)])
+        for name, data in outputs.items():
+            rendered[name.replace(os.sep, "/")] = data
+
+        sock = None
+        try:
+            if address:
+                sock = open_socket(address)
+                stream = sock.makefile("wb")
+            elif destination == "-":
+                stream = getattr(sys.stdout, "buffer", sys.stdout)
+                sys.stdout.flush()
+            else:
+                stream = open(destination, "wb")
+            try:
+                Log.info("Streaming build context %s to %s...", context_dir, destination)
+                # Never pack the archive into itself when it's written inside the context
+                skip = [destination] if not address and destination != "-" else []
+                stream_build_context(stream, context_dir, rendered, int(mtime), skip)
+            finally:
+                if destination != "-":
+                    stream.close()
+        except (OSError, IOError) as e:
+            raise FileProcessingError(e, destination)
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def get_output_paths(self, outputs, outfile=None, outdir=None, dockerfile=None):
+        """
+        Return (path, name) pairs for the main output and every named output.
+        Named outputs are relative to outdir, or to the directory of the
+        outfile when rendering to a single file. Paths default to cli arguments.
+        """
+        if outfile is None and outdir is None:
+            outfile = self.args.get("--outfile")
+            outdir = self.args.get("--outdir")
+            dockerfile = self.args["--dockerfile"]
+
+        if outdir:
+            name = os.path.basename(dockerfile)
+            outfile = os.path.join(outdir, name[:-len(".jinja")] if name.endswith(".jinja") else "Dockerfile")
+        else:
+            outdir = os.path.dirname(outfile)
+            if outfile == "-" and outputs:
+                raise FileProcessingError("named outputs can't be written next to stdout, use --outdir", outfile)
+
+        paths = [(outfile, None)]
+        paths.extend((os.path.join(outdir, name), name) for name in outputs)
+
+        seen = set()
+        for path, name in paths:
+            normalized = os.path.normpath(path)
+            if normalized in seen:
+                raise FileProcessingError("named output '{0}' would overwrite another output".format(name), path)
+            seen.add(normalized)
+        return paths
+
+    def write_outputs(self, out_data, outputs, paths=None):
+        """
+        Write the rendered Dockerfile and all named outputs of the same render.
+        """
+        for path, name in paths or self.get_output_paths(outputs):
+            if path == "-":
+                sys.stdout.write(out_data)
+                sys.stdout.flush()
+                continue
+            try:
+                directory = os.path.dirname(path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(path, "w") as stream:
+                    Log.info("Writing to %s...", path)
+                    stream.write(out_data if name is None else outputs[name])
+            except (OSError, IOError) as e:
+                raise FileProcessingError(e, path)
+
+    def compile_template(self, environment, source, overrides=()):
+        """
+        Compile template source, compiled templates are reused for the same source.
+        At most TEMPLATE_CACHE_SIZE templates are kept.
+
+        If variables are marked as varying with --vary the template is
+        specialized against the rest of the config once and the residual
+        template is reused for every following render.
+
+        Specialized templates depend on the config they were specialized
+        against and are compiled again once config data is merged.
+
+        :param overrides: Names overridden for this render only, they always vary.
+        """
+        varying = self.args.get("--vary") or []
+        if varying:
+            key = (source, frozenset(varying).union(overrides), self.config.generation)
+        else:
+            key = (source, frozenset(), None)
+        template = self.templates.get(key)
+        if template is not None:
+            self.compile_stats["compile_hits"] += 1
+            return template
+
+        self.compile_stats["compile_misses"] += 1
+        if varying:
+            Log.debug("Specializing template, varying on %s", sorted(key[1]))
+            template = specialize(environment, source, self.config.get_tree(), key[1], self.render_template)
+        else:
+            template = environment.from_string(source)
+        self.templates[key] = template
+        return template
+
+    def render_template(self, template, context, outputs=None):
+        """
+        Render template with given context mapping.
+
+        Unlike template.render(**context) the mapping is not copied, values are
+        only looked up when the template uses them, so lazy config subtrees
+        that are never referenced are never loaded.
+
+        :param outputs: Mapping that collects named {% output %} blocks.
+        """
+        maps = [context, template.globals]
+        if outputs is not None:
+            maps.insert(0, {OUTPUTS_KEY: outputs})
+        ctx = template.new_context(ContextChain(*maps), shared=True)
+        limits = self.get_render_limits()
+        try:
+            if limits is not None:
+                return limits.render(template.root_render_func(ctx))
+            return u"".join(template.root_render_func(ctx))
+        except Exception:
+            # Let jinja rewrite the traceback to point into the template
+            return template.environment.handle_exception()
 
     def attach_function(self, attr, func, name):
         """
@@ -157,23 +650,87 @@ class Core(object):
         Given a jinja templated environment, updated with our globals and filters.
         """
         # we'll render a file, so we should preserve newlines as they are
-        environment = Environment(keep_trailing_newline=True)
+        options = dict(keep_trailing_newline=True, extensions=[FragmentCacheExtension, OutputExtension])
+        if self.args.get("--sandbox") or self.get_render_limits() is not None:
+            environment = LimitedEnvironment(sandbox=self.args.get("--sandbox", False), **options)
+        else:
+            environment = Environment(**options)
         for n in ('globals', 'filters'):
             env_vars = getattr(environment, n)
             env_vars.update(self.environment_vars[n])
+        environment.globals["env"] = LazyEnviron(self.args.get("--env-prefix"), self.args.get("--env-file") or [])
+        environment.fragment_cache = self.get_fragment_cache()
         return environment
 
+    def get_fragment_cache(self):
+        """
+        Fragment cache used by {% cache %} blocks, configured from cli.
+        """
+        if self.fragment_cache is None:
+            self.fragment_cache = get_fragment_cache(
+                self.args.get("--cache-dir"),
+                self.get_number_arg("--cache-ttl", float),
+                self.get_number_arg("--cache-size", int),
+            )
+        return self.fragment_cache
+
+    def get_render_limits(self):
+        """
+        Render limits configured from cli, None if no limit is set.
+        """
+        if self.render_limits is None:
+            limits = RenderLimits(
+                timeout=self.get_number_arg("--timeout", float),
+                max_output=self.get_number_arg("--max-output", int),
+                max_loop=self.get_number_arg("--max-loop", int),
+                max_depth=self.get_number_arg("--max-depth", int),
+            )
+            if any(v is not None for v in vars(limits).values()):
+                self.render_limits = limits
+            else:
+                self.render_limits = False
+        return self.render_limits or None
+
+    def get_number_arg(self, name, cast):
+        """
+        Convert a numeric cli argument, missing arguments are returned as None.
+        """
+        value = self.args.get(name)
+        if value is None:
+            return None
+        try:
+            return cast(value)
+        except ValueError:
+            Log.error("%s must be a number, got '%s'", name, value)
+            raise ExitError("invalid argument")
+
     def main(self):
         """
         Runs all logic in application
         """
 
+        self.templates.clear()
+
         try:
             self.load_user_specefied_config_files()
             self.parse_env_vars()
             self.handle_data_sources()
-            self.handle_dockerfile()
+            if self.args.get("check"):
+                self.handle_check()
+            elif self.args.get("stats"):
+                self.handle_stats()
+            elif self.args.get("batch"):
+                self.handle_batch()
+            elif self.args.get("--stream"):
+                self.handle_stream(sys.stdin, sys.stdout)
+            else:
+                self.handle_dockerfile()
         except ExitError:
             sys.exit(1)
 
+        stats = self.fragment_cache.stats() if self.fragment_cache is not None else None
+        if stats and stats["hits"] + stats["disk_hits"] + stats["misses"]:
+            # Only worth logging for templates that use {% cache %}
+            Log.info("Fragment cache: %(hits)s hits, %(disk_hits)s disk hits, %(misses)s misses", stats)
+
         Log.info("Done... Bye :]")
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Partial evaluation of templates against the constant part of a context.
+
+Top level parts of a template that only depend on constant data are rendered
+once and replaced by their output, the remaining residual template only has
+to evaluate what depends on the varying variables.
+"""
+
+import logging
+
+from jinja2 import meta, nodes
+
+Log = logging.getLogger(__name__)
+
+# Nodes that define names, load other templates or depend on the render
+# context itself. A subtree containing any of them is never folded.
+_UNFOLDABLE_NODES = tuple(getattr(nodes, n) for n in (
+    "Extends", "Block", "Include", "Import", "FromImport", "Macro",
+    "Assign", "AssignBlock", "ContextReference", "DerivedContextReference",
+    "EvalContextModifier", "ScopedEvalContextModifier",
+) if hasattr(nodes, n))
+
+# Top level statements that are folded as a whole
+_FOLDABLE_STATEMENTS = tuple(getattr(nodes, n) for n in (
+    "If", "For", "FilterBlock", "With", "Scope", "CallBlock",
+) if hasattr(nodes, n))
+
+# Names provided by jinja at runtime that never come from the context
+RUNTIME_NAMES = frozenset(["self", "loop", "caller", "varargs", "kwargs", "super"])
+
+
+def _assigned_names(tree):
+    """
+    Names bound anywhere in the template by set, macro or import statements.
+    """
+    names = set()
+    for node in tree.find_all((nodes.Assign, getattr(nodes, "AssignBlock", nodes.Assign))):
+        targets = [node.target] if isinstance(node.target, nodes.Name) else node.target.find_all(nodes.Name)
+        names.update(n.name for n in targets)
+    for node in tree.find_all(nodes.Macro):
+        names.add(node.name)
+    for node in tree.find_all(nodes.Import):
+        names.add(node.target)
+    for node in tree.find_all(nodes.FromImport):
+        for name in node.names:
+            names.add(name[1] if isinstance(name, tuple) else name)
+    return names
+
+
+class Specializer(object):
+    """
+    Folds the constant parts of a parsed template.
+    """
+
+    def __init__(self, environment, context, varying, render):
+        """
+        :param environment: Jinja environment the template belongs to.
+        :param context: Mapping with the constant part of the context.
+        :param varying: Names whose values change between renders.
+        :param render: Callable rendering a template with a context mapping.
+        """
+        self.environment = environment
+        self.context = context
+        self.varying = frozenset(varying)
+        self.render = render
+        self.blocked = frozenset()
+        self.folded = 0
+
+    def _wrap(self, body):
+        tree = nodes.Template(body, lineno=1)
+        tree.set_environment(self.environment)
+        return tree
+
+    def is_foldable(self, node):
+        if isinstance(node, _UNFOLDABLE_NODES) or node.find(_UNFOLDABLE_NODES) is not None:
+            return False
+        try:
+            undeclared = meta.find_undeclared_variables(self._wrap([node]))
+        except Exception:
+            return False
+        return not (undeclared & self.blocked)
+
+    def evaluate(self, node):
+        """
+        Render a single node on its own. Returns None if it can't be folded.
+        """
+        if not self.is_foldable(node):
+            return None
+        try:
+            template = self.environment.from_string(self._wrap([node]))
+            data = self.render(template, self.context)
+        except Exception as e:
+            # Leave it to the real render to raise the error at the right time
+            Log.debug("Not folding node at line %s: %s", node.lineno, e)
+            return None
+        self.folded += 1
+        return data
+
+    def fold(self, tree):
+        self.blocked = self.varying | RUNTIME_NAMES | _assigned_names(tree)
+
+        body = []
+        for node in tree.body:
+            if isinstance(node, nodes.Output):
+                children = []
+                for child in node.nodes:
+                    if not isinstance(child, nodes.TemplateData):
+                        data = self.evaluate(nodes.Output([child], lineno=child.lineno))
+                        if data is not None:
+                            child = nodes.TemplateData(data, lineno=child.lineno)
+                    children.append(child)
+                node = nodes.Output(children, lineno=node.lineno)
+            elif isinstance(node, _FOLDABLE_STATEMENTS):
+                data = self.evaluate(node)
+                if data is not None:
+                    node = nodes.Output([nodes.TemplateData(data, lineno=node.lineno)], lineno=node.lineno)
+            self._append(body, node)
+
+        return self._wrap(body)
+
+    @staticmethod
+    def _append(body, node):
+        """
+        Append node to body, merging adjacent constant output into one node.
+        """
+        if isinstance(node, nodes.Output):
+            children = []
+            for child in node.nodes:
+                if children and isinstance(child, nodes.TemplateData) and isinstance(children[-1], nodes.TemplateData):
+                    children[-1] = nodes.TemplateData(children[-1].data + child.data, lineno=children[-1].lineno)
+                else:
+                    children.append(child)
+            node = nodes.Output(children, lineno=node.lineno)
+
+            if body and isinstance(body[-1], nodes.Output):
+                node = nodes.Output(body.pop().nodes + node.nodes, lineno=node.lineno)
+                return Specializer._append(body, node)
+        body.append(node)
+
+
+def specialize(environment, source, context, varying, render):
+    """
+    Return a residual template for source where everything that doesn't
+    depend on the varying names is precomputed from context.
+
+    Rendering the residual template with a full context gives exactly the
+    same output as rendering source. Templates using inheritance are
+    compiled unchanged.
+    """
+    tree = environment.parse(source)
+    if tree.find(nodes.Extends) is not None:
+        return environment.from_string(tree)
+
+    specializer = Specializer(environment, context, varying, render)
+    residual = specializer.fold(tree)
+    Log.debug("Folded %s template nodes, varying on %s", specializer.folded, sorted(specializer.varying))
+    return environment.from_string(residual)
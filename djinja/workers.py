@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+""" Forked worker pools for running a function over many items """
+
+import multiprocessing
+
+# Function run by a worker process, only ever set within workers
+_worker_func = None
+
+
+def _init_worker(func):
+    global _worker_func
+    _worker_func = func
+
+
+def _call_in_worker(item):
+    return _worker_func(item)
+
+
+def fork_context():
+    """
+    Workers must be forked to inherit the loaded environment, which holds
+    datasource functions that can't be pickled. None where fork isn't available.
+    """
+    try:
+        return multiprocessing.get_context("fork")
+    except (AttributeError, ValueError):
+        return None
+
+
+def map_forked(func, items, jobs, chunksize=1):
+    """
+    Return [func(item) for item in items], computed by jobs forked workers.
+
+    func doesn't need to be picklable, only items and results are sent between
+    processes. Items are handed out in order and results are returned in it.
+    Runs in the current process if jobs < 2 or fork isn't available.
+    """
+    context = fork_context()
+    if jobs < 2 or len(items) < 2 or context is None:
+        return [func(item) for item in items]
+
+    # Forked workers receive func without pickling it
+    pool = context.Pool(min(jobs, len(items)), initializer=_init_worker, initargs=(func,))
+    try:
+        return pool.map(_call_in_worker, items, chunksize)
+    finally:
+        pool.close()
+        pool.join()
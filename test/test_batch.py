@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# djinja package imports
+from djinja import FileProcessingError
+from djinja.batch import assign_shards, load_targets, load_timings, parse_shard, run_targets, save_timings, schedule
+
+# 3rd party imports
+import pytest
+
+
+def _targets(*names):
+    return [{"name": n} for n in names]
+
+
+def test_load_targets(tmpdir):
+    f = tmpdir.join("targets.yaml")
+    f.write("- dockerfile: a.jinja\n  outfile: a/Dockerfile\n- {name: b, dockerfile: b.jinja, outdir: b}\n")
+    targets = load_targets(str(f))
+    assert [t["name"] for t in targets] == ["a/Dockerfile", "b"]
+    assert targets[0]["dockerfile"] == str(tmpdir.join("a.jinja"))
+    assert targets[1]["outdir"] == str(tmpdir.join("b"))
+
+    f.write("- {name: a, dockerfile: a.jinja, outfile: a}\n- {name: a, dockerfile: b.jinja, outfile: b}\n")
+    with pytest.raises(FileProcessingError):
+        load_targets(str(f))
+
+
+def test_parse_shard():
+    assert parse_shard("1/1") == (1, 1)
+    assert parse_shard("3/4") == (3, 4)
+    for text in ("0/2", "3/2", "1", "a/b", "1/0"):
+        with pytest.raises(ValueError):
+            parse_shard(text)
+
+
+def test_timings(tmpdir):
+    f = tmpdir.join("timings.json")
+    assert load_timings([str(f)]) == {}
+
+    save_timings(str(f), {"a": 1.5, "b": 2})
+    save_timings(str(f), {"b": 3})
+    assert load_timings([str(f)]) == {"a": 1.5, "b": 3}
+
+    for content in ("[]", '{"targets": {"a": null}}', '{"targets": {"a": "x"}}', '{"targets": {"a": "nan"}}',
+                    '{"targets": {"a": Infinity}}', '{"targets": {"a": -1}}'):
+        f.write(content)
+        with pytest.raises(FileProcessingError):
+            load_timings([str(f)])
+
+
+def test_assign_shards_balanced():
+    targets = _targets("a", "b", "c", "d", "e")
+    timings = {"a": 10, "b": 1, "c": 6, "d": 4, "e": 1}
+    shards = assign_shards(targets, 2, timings)
+
+    assert [[t["name"] for t in s] for s in shards] == [["a", "b"], ["c", "d", "e"]]
+    assert [sum(timings[t["name"]] for t in s) for s in shards] == [11, 11]
+
+
+def test_assign_shards_covers_all_targets():
+    targets = _targets(*("t{0}".format(n) for n in range(23)))
+    shards = assign_shards(targets, 4, {"t3": 5.0})
+
+    names = sorted(t["name"] for s in shards for t in s)
+    assert names == sorted(t["name"] for t in targets)
+    assert [len(s) for s in shards] == [6, 6, 6, 5]
+    # Every node computes the same split
+    assert assign_shards(list(targets), 4, {"t3": 5.0}) == shards
+
+
+def test_schedule():
+    targets = _targets("a", "b", "c", "d")
+    assert [t["name"] for t in schedule(targets, {"a": 1, "b": 5, "d": 1})] == ["c", "b", "a", "d"]
+
+
+def _render_name(target):
+    return target["name"].upper()
+
+
+def test_run_targets():
+    targets = _targets(*"abcdef")
+    assert run_targets(_render_name, targets) == list("ABCDEF")
+    assert run_targets(_render_name, targets, jobs=3) == list("ABCDEF")
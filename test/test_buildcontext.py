@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# python std lib
+import io
+import os
+import socket
+import tarfile
+import threading
+
+# djinja package imports
+from djinja.buildcontext import DockerIgnore, TarStream, stream_build_context
+from djinja.main import Core
+
+# 3rd party imports
+import pytest
+
+
+def read_tar(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return dict((m.name, tar.extractfile(m).read() if m.isfile() else None) for m in tar.getmembers())
+
+
+@pytest.fixture
+def context_dir(tmpdir):
+    ctx = tmpdir.mkdir("context")
+    ctx.join("app.py").write("print('app')\n")
+    ctx.join("big.bin").write_binary(os.urandom(100000))
+    ctx.join("debug.log").write("log")
+    ctx.mkdir("build").join("out.o").write("obj")
+    ctx.mkdir("docs").join("keep.md").write("keep")
+    ctx.join("docs", "skip.md").write("skip")
+    ctx.join(".dockerignore").write("# comment\n*.log\nbuild\ndocs/*.md\n!docs/keep.md\n")
+    ctx.join("Dockerfile.jinja").write("FROM {{ base }}\nCOPY app.py /app.py\n")
+    return ctx
+
+
+class TestDockerIgnore(object):
+
+    def test_matches(self):
+        ignore = DockerIgnore.from_text("*.log\n/build\n**/*.tmp\ndocs\n!docs/README.md\n")
+        assert ignore.matches("debug.log")
+        assert not ignore.matches("sub/debug.log")
+        assert ignore.matches("build")
+        assert ignore.matches("build/sub/file")
+        assert ignore.matches("a/b/c.tmp")
+        assert ignore.matches("c.tmp")
+        assert ignore.matches("docs/other.md")
+        assert not ignore.matches("docs/README.md")
+        assert not ignore.matches("app.py")
+
+    def test_empty(self):
+        assert not DockerIgnore([]).matches("anything")
+
+    def test_parent_directories(self, tmpdir):
+        """
+        Patterns match at any depth of parent directories, also with exceptions
+        """
+        ignore = DockerIgnore.from_text("**/node_modules\n*.txt\n!keep.txt\n")
+        assert ignore.matches("node_modules")
+        assert ignore.matches("node_modules/secret2")
+        assert ignore.matches("a/node_modules/x/y")
+        assert ignore.matches("a/b/node_modules/secret")
+        assert ignore.matches("notes.txt")
+        assert not ignore.matches("keep.txt")
+        assert not ignore.matches("a/b/other")
+
+        ctx = tmpdir.mkdir("ctx")
+        ctx.ensure("node_modules", "secret2")
+        ctx.ensure("a", "b", "node_modules", "secret")
+        ctx.ensure("a", "b", "main.py")
+        ctx.join("notes.txt").write("x")
+        ctx.join("keep.txt").write("x")
+        ctx.join(".dockerignore").write("**/node_modules\n*.txt\n!keep.txt\n")
+
+        buf = io.BytesIO()
+        stream_build_context(buf, str(ctx), {"Dockerfile": u"FROM scratch\n"})
+        assert sorted(read_tar(buf.getvalue())) == [
+            ".dockerignore", "Dockerfile", "a", "a/b", "a/b/main.py", "keep.txt",
+        ]
+
+
+class TestTarStream(object):
+
+    def test_stream_to_file(self, tmpdir, context_dir):
+        """
+        Streaming to a real file uses sendfile and must produce a valid archive
+        """
+        out = tmpdir.join("context.tar")
+        with open(str(out), "wb") as stream:
+            size = stream_build_context(stream, str(context_dir), {"Dockerfile": u"FROM scratch\n"})
+
+        members = read_tar(out.read_binary())
+        assert size == os.path.getsize(str(out))
+        assert sorted(members) == [
+            ".dockerignore", "Dockerfile", "Dockerfile.jinja", "app.py", "big.bin", "docs", "docs/keep.md",
+        ]
+        assert members["Dockerfile"] == b"FROM scratch\n"
+        assert members["big.bin"] == context_dir.join("big.bin").read_binary()
+
+    def test_stream_in_memory(self, context_dir):
+        """
+        File objects without a file descriptor fall back to copying
+        """
+        buf = io.BytesIO()
+        rendered = {"Dockerfile": u"FROM scratch\n", ".dockerignore": u"*.py\n"}
+        stream_build_context(buf, str(context_dir), rendered)
+
+        members = read_tar(buf.getvalue())
+        assert "app.py" not in members
+        assert "debug.log" in members
+        assert members[".dockerignore"] == b"*.py\n"
+
+    def test_file_changed_size(self, tmpdir):
+        f = tmpdir.join("file")
+        f.write("foobar")
+        tar = TarStream(io.BytesIO())
+        with open(str(f), "rb") as stream:
+            with pytest.raises(IOError):
+                tar._copy(stream, 100)
+
+
+def test_build_context_socket(tmpdir, context_dir):
+    """
+    Send the build context to a stand-in daemon listening on a unix socket
+    """
+    address = str(tmpdir.join("daemon.sock"))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen(1)
+    received = []
+
+    def daemon():
+        conn, _ = server.accept()
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        conn.close()
+        received.append(b"".join(chunks))
+
+    t = threading.Thread(target=daemon)
+    t.start()
+
+    c = Core({
+        "--dockerfile": str(context_dir.join("Dockerfile.jinja")),
+        "--build-context": str(context_dir),
+        "--socket": "unix:" + address,
+    })
+    c.config.merge_data_tree({"base": "debian"})
+    c.handle_dockerfile()
+    t.join(5)
+    server.close()
+
+    members = read_tar(received[0])
+    assert members["Dockerfile"] == b"FROM debian\nCOPY app.py /app.py\n"
+    assert "build/out.o" not in members
+
+
+def test_build_context_outfile_inside_context(context_dir):
+    """
+    The archive must not pack itself when written inside the context
+    """
+    out = context_dir.join("context.tar")
+    c = Core({
+        "--dockerfile": str(context_dir.join("Dockerfile.jinja")),
+        "--build-context": str(context_dir),
+        "--outfile": str(out),
+    })
+    c.handle_dockerfile()
+    assert "context.tar" not in read_tar(out.read_binary())
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# djinja package imports
+from djinja import ExitError, check
+from djinja.check import TemplateChecker, find_templates, run_checks
+from djinja.main import Core
+
+# 3rd party imports
+import pytest
+
+
+@pytest.fixture
+def checker():
+    c = Core({})
+    c.config.merge_data_tree({"asd": {"dsa": True, "list": [1]}, "OS": "debian"})
+    return TemplateChecker(c.get_template_environment(), c.config.get_tree())
+
+
+class TestTemplateChecker(object):
+
+    def test_valid(self, checker):
+        source = (
+            "FROM {{ OS|upper }}\n"
+            "{% for i in range(3) %}{{ loop.index }}{% endfor %}\n"
+            "{% set x = 1 %}{{ x }}{{ asd.dsa }}{{ asd['list'][0] }}{{ env.HOME }}"
+        )
+        assert checker.check_source(source) == []
+
+    def test_syntax_error(self, checker):
+        assert checker.check_source("\n{% if %}") == [(2, "syntax error: Expected an expression, got 'end of statement block'")]
+
+    def test_unknown_filters_and_tests(self, checker):
+        issues = checker.check_source("{{ OS|nope }}\n{% if OS is weird %}{{ OS|nope2 }}{% endif %}")
+        assert issues == [
+            (1, "unknown filter 'nope'"),
+            (2, "unknown filter 'nope2'"),
+            (2, "unknown test 'weird'"),
+        ]
+
+    def test_undefined_and_missing_keys(self, checker):
+        issues = checker.check_source("{{ foo }}\n{{ asd.missing.deeper }}\n{{ asd.list.x }}")
+        assert issues == [
+            (1, "undefined variable 'foo'"),
+            (2, "config key 'asd.missing' is missing"),
+        ]
+
+    def test_methods_and_guarded_keys(self, checker):
+        source = (
+            "{{ asd.get('x', 1) }}{{ asd.missing.get('x') }}\n"
+            "{% for k, v in asd.items() %}{{ k }}{% endfor %}{{ asd.keys }}\n"
+            "{% if asd.opt is defined %}{{ asd.opt }}{% endif %}\n"
+            "{{ asd.other|default('x') }}{{ asd.other.deeper }}{{ asd.nope|d }}\n"
+            "{% if asd.guarded.x is undefined %}{{ asd.guarded }}{% endif %}\n"
+            "{{ asd.really_missing }}"
+        )
+        assert checker.check_source(source) == [
+            (1, "config key 'asd.missing' is missing"),
+            (6, "config key 'asd.really_missing' is missing"),
+        ]
+
+    def test_cache(self, tmpdir, checker, monkeypatch):
+        checker.cache_dir = str(tmpdir)
+        assert checker.check_source("{{ foo }}") == [(1, "undefined variable 'foo'")]
+
+        # Cached results must be used without analysing the template again
+        monkeypatch.setattr(checker, "_analyse", None)
+        assert checker.check_source("{{ foo }}") == [(1, "undefined variable 'foo'")]
+
+
+def test_run_checks_parallel(tmpdir, checker, monkeypatch):
+    """
+    Parallel and serial checks must report the same issues in the same order
+    """
+    monkeypatch.setattr(check, "MIN_PARALLEL_TEMPLATES", 2)
+    for n in range(6):
+        d = tmpdir.mkdir("t{0}".format(n))
+        d.join("Dockerfile.jinja").write("{{ OS }}" if n % 2 else "{{ missing%s }}" % n)
+        d.join("README.md").write("not a template")
+
+    paths = find_templates([str(tmpdir)])
+    assert len(paths) == 6
+
+    serial = run_checks(checker, paths, 1)
+    assert run_checks(checker, paths, 3) == serial
+    assert serial == [
+        "{0}:1: undefined variable 'missing{1}'".format(tmpdir.join("t{0}".format(n), "Dockerfile.jinja"), n)
+        for n in (0, 2, 4)
+    ]
+
+
+def test_handle_check(tmpdir, capsys):
+    good = tmpdir.join("good.jinja")
+    good.write("FROM {{ OS }}")
+    bad = tmpdir.join("bad.jinja")
+    bad.write("FROM {{ OS|nope }}")
+
+    c = Core({"check": True, "PATH": [str(good)], "--env": ["OS=debian"]})
+    c.parse_env_vars()
+    c.handle_check()
+
+    c = Core({"check": True, "PATH": [str(tmpdir)], "--env": ["OS=debian"]})
+    c.parse_env_vars()
+    with pytest.raises(ExitError):
+        c.handle_check()
+    assert capsys.readouterr().out == "{0}:1: unknown filter 'nope'\n".format(bad)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 # djinja package imports
-from djinja.conftree import ConfTree
+from djinja import FileProcessingError
+from djinja.conftree import ConfTree, get_config_index
 
 # 3rd party imports
 import pytest
@@ -91,3 +92,90 @@ class TestConfTree(object):
         assert c.get("bar", -1) == 1
         assert c.get("qwe", "ytr") == "rty"
         assert c.get("foobar", "barfoo") == "barfoo"
+
+    def test_lazy_load_yaml(self, tmpdir):
+        """
+        In lazy mode only the top level keys that are looked up should be parsed
+        """
+        f = tmpdir.join("conf.yaml")
+        f.write("# comment\nfoo: bar\nmatrix:\n  a: [1, 2]\n  b: {c: d}\nbroken: [\n")
+
+        c = ConfTree(lazy=True)
+        c.load_config_file(str(f))
+        assert sorted(c.get_tree()) == ["broken", "foo", "matrix"]
+        assert c.get("foo") == "bar"
+        assert c.get("matrix") == {"a": [1, 2], "b": {"c": "d"}}
+        assert c.tree.pending.keys() == set(["broken"])
+
+    def test_lazy_load_json(self, tmpdir):
+        f = tmpdir.join("conf.json")
+        f.write('{"foo": "b,a}r", "list": [1, {"x": "]"}], "num": 1.5, "null": null}')
+
+        c = ConfTree(lazy=True)
+        c.load_config_file(str(f))
+        assert c.get("list") == [1, {"x": "]"}]
+        assert c.get("num") == 1.5
+        assert c.get("foo") == "b,a}r"
+        assert c.get("null", "default") is None
+        assert c.get("missing", "default") == "default"
+
+    def test_lazy_merge(self, tmpdir):
+        """
+        Later config files and merged data should override indexed keys
+        """
+        f1 = tmpdir.join("a.json")
+        f1.write('{"foo": 1, "bar": 1}')
+        f2 = tmpdir.join("b.yaml")
+        f2.write("bar: 2\n")
+
+        c = ConfTree(lazy=True)
+        c.load_config_files([str(f1), str(f2)])
+        c.merge_data_tree({"foo": 3})
+        assert dict(c.get_tree()) == {"foo": 3, "bar": 2}
+
+    def test_lazy_file_changed_after_indexing(self, tmpdir):
+        """
+        Rewriting a config file after it was indexed must not break or corrupt
+        lookups, keys are loaded from the file as it is now
+        """
+        f = tmpdir.join("conf.json")
+        f.write('{"big": {"a": [1, 2, 3]}, "small": 1}')
+
+        c = ConfTree(lazy=True)
+        c.load_config_file(str(f))
+        with open(str(f), "w") as stream:
+            stream.write('{"big": 2}')
+        assert c.get("big") == 2
+        with pytest.raises(FileProcessingError):
+            c.get("small")
+
+    def test_lazy_keeps_only_spans(self, tmpdir):
+        """
+        The index must not hold the file content, untouched subtrees are
+        never read or parsed
+        """
+        f = tmpdir.join("conf.yaml")
+        f.write("big:\n" + "".join("  k{0}: [1, 2, 3]\n".format(i) for i in range(1000)) + "small: 1\n")
+
+        c = ConfTree(lazy=True)
+        c.load_config_file(str(f))
+        index = get_config_index(str(f))
+        assert index.buf is None
+        assert c.get("small") == 1
+        assert list(index.parsed) == ["small"]
+        assert c.tree.pending.keys() == set(["big"])
+
+    def test_lazy_unsplittable_yaml(self, tmpdir):
+        """
+        YAML using anchors can't be split and must fall back to an eager load
+        """
+        from djinja import conftree
+
+        f = tmpdir.join("anchors.yaml")
+        f.write("base: &base\n  a: 1\nother: *base\n")
+        assert conftree.get_config_index(str(f)) is None
+
+    def test_lazy_load_file_not_exists(self):
+        c = ConfTree(lazy=True)
+        with pytest.raises(Exception):
+            c.load_config_file("/tmp/foobar/opalopa")
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 
 # python std lib
+import errno
 import os
 
 # djinja package imports
+from djinja import FileProcessingError
+from djinja.contrib import file
+from djinja.environ import LazyEnviron
 from djinja.main import Core
 
+# 3rd party imports
+import pytest
+from jinja2.utils import LRUCache
+
 
 class TestContribBasic(object):
 
@@ -59,3 +67,123 @@ class TestContribFile(object):
         c.main()
 
         assert o.read().startswith("File exists: True"), "{0}".format(o.read())
+
+    def test_file_contents(self, tmpdir):
+        snippet = tmpdir.join("snippet.sh")
+        snippet.write("echo foo\n")
+        empty = tmpdir.join("empty.txt")
+        empty.write("")
+        o = tmpdir.join("Dockerfile")
+        i = tmpdir.join("Dockerfile.jinja")
+        i.write("RUN {{ file_contents('%s') }}[{{ file_contents('%s') }}]" % (str(snippet), str(empty)))
+
+        c = Core({
+            "--dockerfile": str(i),
+            "--outfile": str(o),
+        })
+        c.main()
+        assert o.read() == "RUN echo foo\n[]"
+
+        # Changing the file on disk must invalidate the cached content
+        snippet.write("echo barfoo\n")
+        c.main()
+        assert o.read() == "RUN echo barfoo\n[]"
+
+    def test_files_exist(self, tmpdir):
+        tmpdir.join("a.txt").write("a")
+        tmpdir.mkdir("sub").join("b.txt").write("b")
+        o = tmpdir.join("Dockerfile")
+        i = tmpdir.join("Dockerfile.jinja")
+        paths = [
+            str(tmpdir.join("a.txt")),
+            str(tmpdir.join("sub", "b.txt")),
+            str(tmpdir.join("sub", "c.txt")),
+            "/tmp/foobar/barfoo/raboof",
+            str(tmpdir.join("a.txt")) + "/",
+            str(tmpdir.join("sub")) + "/",
+            str(tmpdir.join("dangling")),
+            str(tmpdir.join("link")),
+        ]
+        tmpdir.join("dangling").mksymlinkto(tmpdir.join("nope"))
+        tmpdir.join("link").mksymlinkto(tmpdir.join("a.txt"))
+        i.write("{{ files_exist(%r) }}" % paths)
+
+        c = Core({
+            "--dockerfile": str(i),
+            "--outfile": str(o),
+        })
+        c.main()
+        assert o.read() == "[True, True, False, False, False, True, False, True]"
+        assert [os.path.exists(p) for p in paths] == [True, True, False, False, False, True, False, True]
+
+    def test_files_exist_unlistable_directory(self, tmpdir, monkeypatch):
+        """
+        Paths in a directory that can't be listed are checked one by one
+        """
+        tmpdir.join("a.txt").write("a")
+
+        def list_directory(path):
+            raise OSError(errno.EACCES, "Permission denied", path)
+        monkeypatch.setattr(file, "_list_directory", list_directory)
+
+        paths = [str(tmpdir.join("a.txt")), str(tmpdir.join("b.txt"))]
+        assert file._global_files_exist(paths) == [True, False]
+
+    def test_file_contents_cache_bounded(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(file, "_content_cache", LRUCache(2))
+        for name in ("a", "b", "c"):
+            tmpdir.join(name).write(name)
+            assert file._global_file_contents(str(tmpdir.join(name))) == name
+        assert len(file._content_cache) == 2
+
+    def test_glob(self, tmpdir):
+        tmpdir.join("b.sh").write("b")
+        tmpdir.join("a.sh").write("a")
+        tmpdir.join("c.txt").write("c")
+        o = tmpdir.join("Dockerfile")
+        i = tmpdir.join("Dockerfile.jinja")
+        i.write("{% for f in glob('" + str(tmpdir) + "/*.sh') %}{{ f|basename }} {% endfor %}")
+
+        def basename(path):
+            return os.path.basename(path)
+
+        c = Core({
+            "--dockerfile": str(i),
+            "--outfile": str(o),
+        })
+        c.attach_function("filters", basename, "basename")
+        c.main()
+        assert o.read() == "a.sh b.sh "
+
+
+class TestEnviron(object):
+
+    def test_env_mapping(self, tmpdir, monkeypatch):
+        monkeypatch.setenv("DJ_BASE", "debian")
+        monkeypatch.setenv("OTHER", "x")
+        env_file = tmpdir.join(".env")
+        env_file.write(
+            "# defaults\n"
+            "export DJ_BASE=ignored\n"
+            "DJ_TAG='8 # not a comment'\n"
+            'DJ_MSG="a\\tb"\n'
+            "DJ_PLAIN=value # comment\n"
+        )
+        o = tmpdir.join("Dockerfile")
+        i = tmpdir.join("Dockerfile.jinja")
+        i.write("{{ env.BASE }}:{{ env.TAG }}|{{ env.MSG }}|{{ env.PLAIN }}|{{ 'OTHER' in env }}|{{ env.MISSING }}")
+
+        c = Core({
+            "--dockerfile": str(i),
+            "--outfile": str(o),
+            "--env-prefix": "DJ_",
+            "--env-file": [str(env_file)],
+        })
+        c.main()
+        assert o.read() == "debian:8 # not a comment|a\tb|value|False|"
+
+    def test_env_file_not_parsed_unless_used(self, tmpdir):
+        env = LazyEnviron(env_files=["/tmp/foobar/opalopa"], environ={"FOO": "bar"})
+        assert env["FOO"] == "bar"
+        with pytest.raises(FileProcessingError):
+            env["MISSING"]
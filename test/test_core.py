@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
 # python std lib
+import io
+import json
 import logging
+import sys
 
 # djinja package imports
 import djinja
 from djinja import ExitError
+from djinja.batch import load_timings
+from djinja.extensions import FragmentCache
 from djinja.main import Core
 from djinja.conftree import ConfTree
 
@@ -82,6 +87,19 @@ def test_parse_env_vars_invalid_key():
     assert str(ex.value).startswith("var '=bar' is not of format 'key=value'")
 
 
+def test_parse_env_vars_equal_sign_in_value():
+    """
+    Only the first equal sign separates key and value
+    """
+    c = Core({
+        "--env": [
+            "url=http://foo/?a=b",
+        ]
+    })
+    c.parse_env_vars()
+    assert c.config.get("url") == "http://foo/?a=b"
+
+
 def test_parse_no_env_vars():
     """
     Test that if no env variables is specefied none should be loaded
@@ -287,3 +305,257 @@ def test_debug_logging():
     with LogCapture() as l:
         Log.debug("barfoo")
         l.check(("foobar", "DEBUG", "barfoo"))
+
+
+def test_fragment_cache_stats_logged_on_use(tmpdir):
+    """
+    Fragment cache stats are only logged when a template used {% cache %}
+    """
+    inp = tmpdir.join("Dockerfile.jinja")
+    out = tmpdir.join("Dockerfile")
+    c = Core({"--dockerfile": str(inp), "--outfile": str(out)})
+    c.fragment_cache = FragmentCache()
+
+    for source, logged in (("FROM debian", False), ("{% cache 'k' %}FROM debian{% endcache %}", True)):
+        inp.write(source)
+        with LogCapture("djinja.main") as l:
+            c.main()
+        assert any(r.getMessage().startswith("Fragment cache") for r in l.records) == logged
+
+
+def test_process_dockerfile_lazy_config(tmpdir):
+    """
+    Keys that the template doesn't use must never be parsed in lazy mode.
+    """
+    inp = tmpdir.join("Dockerfile.jinja")
+    inp.write("{{ barfoo }}")
+    out = tmpdir.join("Dockerfile")
+    conf = tmpdir.join("conf.json")
+    conf.write('{"barfoo": "foobar", "unused": [1, 2, nope]}')
+
+    c = Core({
+        "--dockerfile": str(inp),
+        "--outfile": str(out),
+        "--config": [str(conf)],
+        "--lazy-config": True,
+    })
+    c.load_user_specefied_config_files()
+    c.handle_dockerfile()
+    assert out.read() == "foobar"
+    assert "unused" in c.config.tree.pending
+
+
+def test_process_dockerfile_pipes(tmpdir, monkeypatch):
+    """
+    "-" reads the template from stdin and writes the result to stdout
+    """
+    monkeypatch.setattr(sys, "stdin", io.StringIO(u"FROM {{ OS }}"))
+    monkeypatch.setattr(sys, "stdout", io.StringIO())
+
+    c = Core({
+        "--dockerfile": "-",
+        "--outfile": "-",
+        "--env": ["OS=debian"],
+    })
+    c.parse_env_vars()
+    c.handle_dockerfile()
+    assert sys.stdout.getvalue() == "FROM debian"
+
+
+def test_stdout_named_outputs(monkeypatch):
+    """
+    Named outputs have no place to go when the Dockerfile is written to stdout
+    """
+    monkeypatch.setattr(sys, "stdin", io.StringIO(u"{% output 'x' %}x{% endoutput %}"))
+    c = Core({
+        "--dockerfile": "-",
+        "--outfile": "-",
+    })
+    with pytest.raises(ExitError):
+        c.handle_dockerfile()
+
+
+def test_handle_stream(tmpdir):
+    """
+    Every request line gets one response line in order, errors included
+    """
+    tmpl = tmpdir.join("Dockerfile.jinja")
+    tmpl.write("FROM {{ OS }}:{{ version }}")
+    requests = [
+        {"id": 1, "template": "FROM {{ OS }}", "env": {"OS": "debian"}},
+        {"id": 2, "dockerfile": str(tmpl), "env": {"OS": "ubuntu"}},
+        {"id": 3, "template": "{% if %}"},
+        {"id": 4, "template": "{{ OS }}{% output 'run.sh' %}{{ version }}{% endoutput %}"},
+        [],
+    ]
+    instream = io.StringIO(u"\n".join(json.dumps(r) for r in requests) + u"\n\n")
+    outstream = io.StringIO()
+
+    c = Core({"--vary": ["version"]})
+    c.config.merge_data_tree({"OS": "centos", "version": "7"})
+    c.handle_stream(instream, outstream)
+
+    responses = [json.loads(l) for l in outstream.getvalue().splitlines()]
+    assert len(responses) == 5
+    assert responses[0] == {"id": 1, "output": "FROM debian", "outputs": {}}
+    assert responses[1] == {"id": 2, "output": "FROM ubuntu:7", "outputs": {}}
+    assert responses[2]["id"] == 3
+    assert responses[2]["error"].startswith("TemplateSyntaxError")
+    assert responses[3] == {"id": 4, "output": "centos", "outputs": {"run.sh": "7"}}
+    assert "error" in responses[4]
+
+
+def test_handle_stream_bounded_templates(monkeypatch):
+    """
+    A long running stream keeps a bounded number of compiled templates
+    """
+    monkeypatch.setattr(djinja.main, "TEMPLATE_CACHE_SIZE", 3)
+    requests = [{"id": n, "template": "{{ %d }}" % (n % 5)} for n in range(20)]
+    outstream = io.StringIO()
+
+    c = Core({})
+    c.handle_stream(io.StringIO(u"\n".join(json.dumps(r) for r in requests)), outstream)
+    assert [json.loads(l)["output"] for l in outstream.getvalue().splitlines()] == [str(n % 5) for n in range(20)]
+    assert len(c.templates) == 3
+
+
+def test_handle_batch(tmpdir):
+    """
+    Every target is rendered, a broken one doesn't stop the others and the
+    layer report predicts what docker has to rebuild
+    """
+    tmpdir.join("web.jinja").write("FROM {{ OS }}\nRUN echo {{ version }}\n")
+    tmpdir.join("broken.jinja").write("{% if %}")
+    tmpdir.join("targets.yaml").write(
+        "- name: web\n"
+        "  dockerfile: web.jinja\n"
+        "  outfile: web/Dockerfile\n"
+        "- name: broken\n"
+        "  dockerfile: broken.jinja\n"
+        "  outfile: broken/Dockerfile\n"
+        "- dockerfile: web.jinja\n"
+        "  outdir: db\n"
+        "  env:\n"
+        "    OS: ubuntu\n"
+    )
+    tmpdir.mkdir("web").join("Dockerfile").write("FROM debian\nRUN echo 1\n")
+    report = tmpdir.join("report.json")
+
+    c = Core({
+        "TARGETS": str(tmpdir.join("targets.yaml")),
+        "--layer-report": str(report),
+    })
+    c.config.merge_data_tree({"OS": "debian", "version": "2"})
+    with pytest.raises(ExitError):
+        c.handle_batch()
+
+    assert tmpdir.join("web", "Dockerfile").read() == "FROM debian\nRUN echo 2\n"
+    assert tmpdir.join("db", "web").read() == "FROM ubuntu\nRUN echo 2\n"
+
+    targets = json.loads(report.read())["targets"]
+    assert [(t["name"], t["status"], t["rebuild"]) for t in targets] == [
+        ("web", "changed", True),
+        ("broken", "error", True),
+        ("db", "new", True),
+    ]
+    assert targets[0]["first_invalidated"] == {"index": 1, "line": 2, "instruction": "RUN echo 2"}
+    assert targets[1]["error"].startswith("TemplateSyntaxError")
+
+
+def test_previous_render_read_only_for_layer_report(tmpdir, monkeypatch):
+    """
+    Previous renders are only read when a layer report is requested
+    """
+    tmpdir.join("web.jinja").write("FROM {{ OS }}\n")
+    tmpdir.join("targets.yaml").write("- dockerfile: web.jinja\n  outfile: web/Dockerfile\n")
+    tmpdir.mkdir("web").join("Dockerfile").write("FROM ubuntu\n")
+
+    def read_previous(path):
+        raise AssertionError("previous render read without --layer-report")
+    monkeypatch.setattr(Core, "read_previous", staticmethod(read_previous))
+
+    c = Core({"TARGETS": str(tmpdir.join("targets.yaml"))})
+    c.config.merge_data_tree({"OS": "debian"})
+    c.handle_batch()
+    assert tmpdir.join("web", "Dockerfile").read() == "FROM debian\n"
+
+
+def test_handle_batch_shards(tmpdir):
+    """
+    Shards render disjoint targets and their timings files and reports merge
+    """
+    tmpdir.join("t.jinja").write("FROM {{ OS }}\n")
+    tmpdir.join("targets.json").write(json.dumps([
+        {"name": n, "dockerfile": "t.jinja", "outfile": n} for n in ("a", "b", "c")
+    ]))
+
+    rendered = []
+    for index in (1, 2):
+        c = Core({
+            "TARGETS": str(tmpdir.join("targets.json")),
+            "--shard": "{0}/2".format(index),
+            "--save-timings": str(tmpdir.join("timings-{0}.json".format(index))),
+            "--layer-report": str(tmpdir.join("report-{0}.json".format(index))),
+        })
+        c.config.merge_data_tree({"OS": "debian"})
+        c.handle_batch()
+
+        report = json.loads(tmpdir.join("report-{0}.json".format(index)).read())
+        assert report["shard"] == {"index": index, "count": 2}
+        rendered.extend(t["name"] for t in report["targets"])
+
+    assert sorted(rendered) == ["a", "b", "c"]
+    assert all(tmpdir.join(n).read() == "FROM debian\n" for n in rendered)
+    timings = load_timings([str(tmpdir.join("timings-1.json")), str(tmpdir.join("timings-2.json"))])
+    assert sorted(timings) == ["a", "b", "c"]
+
+    c = Core({"TARGETS": str(tmpdir.join("targets.json")), "--shard": "3/2"})
+    with pytest.raises(ExitError):
+        c.handle_batch()
+
+    tmpdir.join("broken.json").write('{"targets": {"a": null}}')
+    c = Core({"TARGETS": str(tmpdir.join("targets.json")), "--timings": [str(tmpdir.join("broken.json"))]})
+    with pytest.raises(ExitError):
+        c.handle_batch()
+
+
+def test_handle_batch_history_and_stats(tmpdir, monkeypatch):
+    """
+    Parallel batches record per-target durations and cache counters, which
+    schedule the next run and are summarized by dj stats
+    """
+    tmpdir.join("t.jinja").write("{% cache 'base' %}FROM {{ OS }}{% endcache %}\n")
+    tmpdir.join("targets.json").write(json.dumps([
+        {"name": n, "dockerfile": "t.jinja", "outfile": n} for n in ("a", "b", "c", "d")
+    ]))
+    args = {
+        "TARGETS": str(tmpdir.join("targets.json")),
+        "--cache-dir": str(tmpdir.join("cache")),
+        "--jobs": "2",
+        "--layer-report": str(tmpdir.join("report.json")),
+    }
+    for _ in range(2):
+        c = Core(dict(args))
+        c.config.merge_data_tree({"OS": "debian"})
+        c.handle_batch()
+
+    assert all(tmpdir.join(n).read() == "FROM debian\n" for n in "abcd")
+    report = json.loads(tmpdir.join("report.json").read())
+    assert [t["name"] for t in report["targets"]] == list("abcd")
+
+    runs = c.get_history().runs()
+    assert len(runs) == 2
+    assert sorted(runs[1]["targets"]) == list("abcd")
+    assert all(t["ok"] and t["cache"]["misses"] == 0 for t in runs[1]["targets"].values())
+    assert sorted(c.get_history().durations()) == list("abcd")
+
+    monkeypatch.setattr(sys, "stdout", io.StringIO())
+    c = Core({"stats": True, "--cache-dir": str(tmpdir.join("cache")), "--json": True})
+    c.handle_stats()
+    summary = json.loads(sys.stdout.getvalue())
+    assert summary["runs"] == 2
+    assert len(summary["slowest"]) == 4
+    assert summary["cache"]["fragment_hit_ratio"] > 0
+
+    with pytest.raises(ExitError):
+        Core({"stats": True}).handle_stats()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# djinja package imports
+from djinja.dockerfile import compare, parse_instructions
+
+
+BASE = (
+    "# syntax=docker/dockerfile:1\n"
+    "FROM debian:8\n"
+    "# install packages\n"
+    "RUN apt-get update && \\\n"
+    "    apt-get install -y curl\n"
+    "COPY . /app\n"
+    "CMD [\"/app/run\"]\n"
+)
+
+
+def test_parse_instructions():
+    instructions = parse_instructions(BASE)
+    assert [str(i) for i in instructions] == [
+        "FROM debian:8",
+        "RUN apt-get update && apt-get install -y curl",
+        "COPY . /app",
+        "CMD [\"/app/run\"]",
+    ]
+    assert [i.lineno for i in instructions] == [2, 4, 6, 7]
+
+
+def test_parse_escape_directive_and_heredoc():
+    text = (
+        "# escape=`\n"
+        "FROM windows `\n"
+        "  AS base\n"
+        "RUN <<EOF\n"
+        "echo \\\n"
+        "EOF\n"
+        "run echo done\n"
+    )
+    instructions = parse_instructions(text)
+    assert [i.keyword for i in instructions] == ["FROM", "RUN", "RUN"]
+    assert instructions[0].arguments == "windows AS base"
+    assert instructions[1].arguments == "<<EOF\necho \\\nEOF"
+
+
+def test_compare_new_and_unchanged():
+    report = compare(None, BASE)
+    assert report["status"] == "new"
+    assert report["rebuild"]
+    assert report["first_invalidated"]["index"] == 0
+
+    report = compare(BASE, BASE)
+    assert report["status"] == "unchanged"
+    assert not report["rebuild"]
+    assert report["first_invalidated"] is None
+    assert report["first_context_instruction"] == 2
+
+
+def test_compare_equivalent():
+    report = compare(BASE, BASE.replace("# install packages", "# other comment") + "\n\n")
+    assert report["status"] == "equivalent"
+    assert not report["rebuild"]
+
+
+def test_compare_changed():
+    report = compare(BASE, BASE.replace("CMD [\"/app/run\"]", "CMD [\"/app/start\"]"))
+    assert report["status"] == "changed"
+    assert report["rebuild"]
+    assert report["first_invalidated"] == {"index": 3, "line": 7, "instruction": "CMD [\"/app/start\"]"}
+    assert report["first_context_instruction"] == 2
+
+    report = compare(BASE, BASE.replace("curl", "wget"))
+    assert report["first_invalidated"]["index"] == 1
+    assert report["first_context_instruction"] is None
+
+    # Appended instructions only invalidate the new layers
+    report = compare(BASE, BASE + "EXPOSE 80\n")
+    assert report["status"] == "changed"
+    assert report["first_invalidated"]["index"] == 4
+
+
+def test_parse_shell_shift_is_not_a_heredoc():
+    text = "FROM debian\nRUN echo $((1<<X))\nRUN make\nENV NOTE <<X\nCOPY . /app\n"
+    instructions = parse_instructions(text)
+    assert [str(i) for i in instructions] == [
+        "FROM debian",
+        "RUN echo $((1<<X))",
+        "RUN make",
+        "ENV NOTE <<X",
+        "COPY . /app",
+    ]
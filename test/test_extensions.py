@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# python std lib
+import os
+import time
+
+# djinja package imports
+from djinja import ExitError
+from djinja.extensions import FragmentCache
+from djinja.main import Core
+
+# 3rd party imports
+import pytest
+from jinja2.exceptions import TemplateRuntimeError
+
+
+class TestFragmentCache(object):
+
+    def render(self, source, cache, **context):
+        c = Core({})
+        c.fragment_cache = cache
+        environment = c.get_template_environment()
+        return c.render_template(environment.from_string(source), context)
+
+    def test_cache_block(self):
+        """
+        A cached fragment should be rendered once per key and vary_on values
+        """
+        calls = []
+
+        def packages():
+            calls.append(1)
+            return "curl git"
+
+        cache = FragmentCache()
+        source = "{% cache 'pkgs', OS %}RUN {{ OS }} {{ packages() }}{% endcache %}"
+
+        assert self.render(source, cache, OS="a", packages=packages) == "RUN a curl git"
+        assert self.render(source, cache, OS="a", packages=packages) == "RUN a curl git"
+        assert self.render(source, cache, OS="b", packages=packages) == "RUN b curl git"
+        assert len(calls) == 2
+        assert cache.stats() == {"hits": 1, "disk_hits": 0, "misses": 2, "entries": 2}
+
+    def test_max_entries(self):
+        cache = FragmentCache(max_entries=1)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        assert cache.get("a") is None
+        assert cache.get("b") == "2"
+
+    def test_ttl(self):
+        cache = FragmentCache(ttl=0)
+        cache.set("a", "1")
+        assert cache.get("a") is None
+
+    def test_disk_cache(self, tmpdir):
+        """
+        Fragments stored on disk should be reused by a new cache instance
+        """
+        d = str(tmpdir.join("cache"))
+        source = "{% cache 'k' %}{{ value }}{% endcache %}"
+
+        assert self.render(source, FragmentCache(directory=d), value="foo") == "foo"
+
+        cache = FragmentCache(directory=d)
+        assert self.render(source, cache, value="bar") == "foo"
+        assert cache.stats()["disk_hits"] == 1
+
+        expired = FragmentCache(directory=d, ttl=0)
+        assert self.render(source, expired, value="bar") == "bar"
+
+    def test_body_in_key(self, tmpdir):
+        """
+        Editing the body of a cache block must not serve the old fragment
+        """
+        d = str(tmpdir.join("cache"))
+        assert self.render("{% cache 'k' %}old{% endcache %}", FragmentCache(directory=d)) == "old"
+        assert self.render("{% cache 'k' %}old{% endcache %}", FragmentCache(directory=d)) == "old"
+        assert self.render("{% cache 'k' %}new{% endcache %}", FragmentCache(directory=d)) == "new"
+
+    def test_disk_hit_keeps_expiry(self, tmpdir):
+        """
+        A fragment loaded from disk must expire when the one on disk does
+        """
+        d = str(tmpdir.join("cache"))
+        FragmentCache(directory=d).set("k", "old")
+        path = FragmentCache(directory=d)._path("k")
+        os.utime(path, (time.time() - 50, time.time() - 50))
+
+        cache = FragmentCache(directory=d, ttl=60)
+        assert cache.get("k") == "old"
+        assert cache.entries["k"][0] == os.path.getmtime(path) + 60
+
+    def test_key_not_serializable(self):
+        """
+        Keys must be the same in every run, so objects without a stable JSON
+        form are refused
+        """
+        with pytest.raises(TemplateRuntimeError):
+            self.render("{% cache 'k', value %}x{% endcache %}", FragmentCache(), value=object())
+
+    def test_cache_options(self, tmpdir):
+        c = Core({
+            "--cache-dir": str(tmpdir),
+            "--cache-ttl": "60",
+            "--cache-size": "10",
+        })
+        cache = c.get_fragment_cache()
+        assert (cache.directory, cache.ttl, cache.max_entries) == (str(tmpdir), 60.0, 10)
+        assert c.get_fragment_cache() is cache
+
+
+class TestOutput(object):
+
+    def test_named_outputs(self, tmpdir):
+        """
+        Output blocks should go to their own files, the rest to the Dockerfile
+        """
+        inp = tmpdir.join("Dockerfile.jinja")
+        inp.write(
+            "FROM {{ base }}\n"
+            "{% output 'entrypoint.sh' %}exec {{ cmd }}\n{% endoutput %}"
+            "{% output 'conf/.dockerignore' %}*.pyc\n{% endoutput %}"
+            "{% output 'entrypoint.sh' %}# end\n{% endoutput %}"
+            "CMD /entrypoint.sh\n"
+        )
+        outdir = tmpdir.join("out")
+
+        c = Core({
+            "--dockerfile": str(inp),
+            "--outdir": str(outdir),
+        })
+        c.config.merge_data_tree({"base": "debian", "cmd": "app"})
+        c.handle_dockerfile()
+
+        assert outdir.join("Dockerfile").read() == "FROM debian\nCMD /entrypoint.sh\n"
+        assert outdir.join("entrypoint.sh").read() == "exec app\n# end\n"
+        assert outdir.join("conf", ".dockerignore").read() == "*.pyc\n"
+
+    def test_output_inside_cache(self):
+        """
+        Named outputs written inside a cached block are replayed on a hit
+        """
+        c = Core({})
+        c.fragment_cache = FragmentCache()
+        template = c.get_template_environment().from_string(
+            "{% cache 'k' %}FROM x{% output 'entry.sh' %}run{% endoutput %}{% endcache %}"
+            "{% output 'entry.sh' %} end{% endoutput %}")
+        for _ in range(2):
+            outputs = {}
+            assert c.render_template(template, {}, outputs) == "FROM x"
+            assert outputs == {"entry.sh": "run end"}
+        assert c.fragment_cache.stats()["hits"] == 1
+
+    def test_outputs_next_to_outfile(self, tmpdir):
+        inp = tmpdir.join("Dockerfile.jinja")
+        inp.write("FROM scratch{% output 'extra' %}foo{% endoutput %}")
+        out = tmpdir.join("Dockerfile")
+
+        c = Core({
+            "--dockerfile": str(inp),
+            "--outfile": str(out),
+        })
+        c.handle_dockerfile()
+        assert out.read() == "FROM scratch"
+        assert tmpdir.join("extra").read() == "foo"
+
+    def test_output_outside_outdir(self, tmpdir):
+        c = Core({})
+        environment = c.get_template_environment()
+        for path in ("../escape", "/etc/escape"):
+            template = environment.from_string("{% output '" + path + "' %}x{% endoutput %}")
+            with pytest.raises(TemplateRuntimeError):
+                c.render_template(template, {}, {})
+
+    def test_output_without_name(self):
+        c = Core({})
+        environment = c.get_template_environment()
+        for path in ("", ".", "./"):
+            template = environment.from_string("{% output '" + path + "' %}x{% endoutput %}")
+            with pytest.raises(TemplateRuntimeError):
+                c.render_template(template, {}, {})
+
+    def test_output_overwrites_dockerfile(self, tmpdir):
+        """
+        A named output with the path of the main output must fail, not replace it
+        """
+        inp = tmpdir.join("Dockerfile.jinja")
+        inp.write("FROM x{% output 'Dockerfile' %}OVERWRITTEN{% endoutput %}")
+        for args in ({"--outdir": str(tmpdir.join("out"))}, {"--outfile": str(tmpdir.join("sub", "Dockerfile"))}):
+            args["--dockerfile"] = str(inp)
+            c = Core(args)
+            with pytest.raises(ExitError):
+                c.handle_dockerfile()
+        assert not tmpdir.join("out", "Dockerfile").exists()
+        assert not tmpdir.join("sub", "Dockerfile").exists()
+
+    def test_output_not_collected(self):
+        c = Core({})
+        template = c.get_template_environment().from_string("{% output 'foo' %}x{% endoutput %}")
+        with pytest.raises(TemplateRuntimeError):
+            c.render_template(template, {})
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# python std lib
+import errno
+import os
+
+# djinja package imports
+from djinja import FileProcessingError, workers
+from djinja.history import History, format_summary, new_run, summarize
+from djinja.workers import map_forked
+
+# 3rd party imports
+import pytest
+
+
+def _run(seconds, **targets):
+    return {
+        "time": 1000,
+        "seconds": seconds,
+        "jobs": 1,
+        "shard": None,
+        "targets": dict((name, {"ok": t is not None, "compile": 0.0 if t is None else t[0],
+                                "render": 0.0 if t is None else t[1], "cache": {"hits": 1, "misses": 1}})
+                        for name, t in targets.items()),
+    }
+
+
+def test_append_and_trim(tmpdir):
+    f = tmpdir.join("sub", "history.jsonl")
+    history = History(str(f), max_runs=3)
+    assert history.runs() == []
+
+    for n in range(5):
+        history.append(_run(n, a=(0.1, n)))
+    f.write("{broken\n", mode="a")
+    assert [r["seconds"] for r in history.runs()] == [2, 3, 4]
+
+
+def test_append_shared(tmpdir):
+    """
+    Processes appending to one history must not drop each other's runs
+    """
+    history = History(str(tmpdir.join("history.jsonl")), max_runs=50)
+    map_forked(lambda n: history.append(_run(n, a=(0.1, n))), list(range(20)), 4)
+    assert sorted(r["seconds"] for r in history.runs()) == list(range(20))
+
+
+def test_trim_interrupted(tmpdir, monkeypatch):
+    """
+    A failing trim must leave the history as it was
+    """
+    f = tmpdir.join("history.jsonl")
+    history = History(str(f), max_runs=2)
+    for n in range(2):
+        history.append(_run(n, a=(0.1, n)))
+
+    def rename(src, dst):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    monkeypatch.setattr(os, "rename", rename)
+
+    with pytest.raises(FileProcessingError):
+        history.append(_run(2, a=(0.1, 2)))
+    assert [r["seconds"] for r in history.runs()] == [0, 1, 2]
+    assert sorted(p.basename for p in tmpdir.listdir()) == ["history.jsonl", "history.jsonl.lock"]
+
+
+def test_map_forked_no_shared_state():
+    """
+    The mapped function is handed to the workers, not kept in the parent
+    """
+    def func(n):
+        assert workers._worker_func is None
+        return map_forked(lambda m: n * 10 + m, [0, 1], 2)
+
+    assert [func(n) for n in (1, 2)] == [[10, 11], [20, 21]]
+    assert workers._worker_func is None
+
+
+def test_durations(tmpdir):
+    history = History(str(tmpdir.join("history.jsonl")))
+    history.append(_run(1, a=(1.0, 1.0), b=(0.5, 0.0)))
+    history.append(_run(1, a=(1.0, 3.0), b=None))
+    assert history.durations() == {"a": 3.0, "b": 0.5}
+    assert history.durations(last=1) == {"a": 4.0, "b": 0.5}
+
+
+def test_new_run():
+    results = [
+        {"name": "a", "ok": True, "timings": {"compile": 0.123456, "render": 1.0}, "cache": {"hits": 2}},
+        {"name": "b", "ok": False, "timings": {}, "cache": {}},
+    ]
+    run = new_run(results, 2.5, jobs=4, shard="1/2")
+    assert run["targets"]["a"] == {"ok": True, "compile": 0.1235, "render": 1.0, "cache": {"hits": 2}}
+    assert run["targets"]["b"]["ok"] is False
+    assert (run["seconds"], run["jobs"], run["shard"]) == (2.5, 4, "1/2")
+
+
+def test_summarize():
+    runs = [
+        _run(3, slow=(1.0, 1.0), fast=(0.0, 0.1)),
+        _run(3, slow=(1.0, 3.0), fast=None),
+    ]
+    summary = summarize(runs, top=1)
+
+    assert summary["runs"] == 2
+    assert summary["slowest"] == [{
+        "name": "slow", "runs": 2, "failed": 0, "compile": 1.0, "render": 2.0,
+        "seconds": 3.0, "last": 4.0, "trend": 1.0, "cache_hit_ratio": 0.5,
+    }]
+    assert summary["cache"]["fragment_hit_ratio"] == 0.5
+    assert summary["cache"]["compile_hit_ratio"] is None
+    assert [r["failed"] for r in summary["recent"]] == [0, 1]
+
+    lines = format_summary(summary)
+    assert lines[0] == "2 runs recorded"
+    assert lines[3].split() == ["slow", "1.000", "2.000", "3.000", "4.000", "+100%", "50%"]
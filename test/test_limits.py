@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# python std lib
+import io
+import json
+
+# djinja package imports
+from djinja import ExitError, RenderLimitError, limits
+from djinja.limits import LimitedEnvironment
+from djinja.main import Core
+
+# 3rd party imports
+import pytest
+from jinja2.sandbox import SecurityError
+
+
+def render(source, args, **context):
+    c = Core(args)
+    template = c.get_template_environment().from_string(source)
+    return c.render_template(template, context)
+
+
+class TestLimits(object):
+
+    def test_no_limits(self):
+        """
+        Without limits the plain environment is used
+        """
+        c = Core({})
+        assert not isinstance(c.get_template_environment(), LimitedEnvironment)
+
+    def test_within_limits(self):
+        source = "{% for i in range(3) %}{{ i }}{% endfor %}{{ 'ab' * 2 }}"
+        args = {"--timeout": "10", "--max-output": "100", "--max-loop": "3", "--max-depth": "5"}
+        assert render(source, args) == "012abab"
+
+    def test_timeout(self):
+        with pytest.raises(RenderLimitError) as ex:
+            render("{% for i in range(10 ** 9) %}{% endfor %}", {"--timeout": "0.05"})
+        assert "timed out" in str(ex.value)
+
+    def test_max_output(self):
+        with pytest.raises(RenderLimitError):
+            render("{% for i in range(100) %}xxxxxxxxxx{% endfor %}", {"--max-output": "500"})
+
+        # Huge repetitions are refused before they are built
+        with pytest.raises(RenderLimitError):
+            render("{{ 'x' * 10 ** 12 }}", {"--max-output": "500"})
+
+    def test_max_loop(self):
+        source = "{% for i in range(10) %}{% for j in range(10) %}{% endfor %}{% endfor %}"
+        assert render(source, {"--max-loop": "110"}) == ""
+        with pytest.raises(RenderLimitError):
+            render(source, {"--max-loop": "109"})
+
+    def test_max_depth(self):
+        source = "{% macro r(n) %}{{ n }}{% if n %}{{ r(n - 1) }}{% endif %}{% endmacro %}{{ r(count) }}"
+        assert render(source, {"--max-depth": "10"}, count=5) == "543210"
+        with pytest.raises(RenderLimitError):
+            render(source, {"--max-depth": "10"}, count=50)
+
+    def test_sandbox(self):
+        assert render("{{ foo.upper() }}", {"--sandbox": True}, foo="bar") == "BAR"
+        with pytest.raises(SecurityError):
+            render("{{ foo.__class__.__subclasses__() }}", {"--sandbox": True}, foo="bar")
+
+    def test_invalid_limit(self):
+        with pytest.raises(ExitError):
+            Core({"--timeout": "soon"}).get_render_limits()
+
+    def test_handle_dockerfile(self, tmpdir):
+        inp = tmpdir.join("Dockerfile.jinja")
+        inp.write("{% for i in range(100) %}{{ i }}{% endfor %}")
+        c = Core({
+            "--dockerfile": str(inp),
+            "--outfile": str(tmpdir.join("Dockerfile")),
+            "--max-loop": "10",
+        })
+        with pytest.raises(ExitError) as ex:
+            c.handle_dockerfile()
+        assert ex.value.message == "render limit exceeded"
+
+    def test_stream_keeps_going(self):
+        """
+        A request exceeding a limit fails alone, the next one renders
+        """
+        requests = [
+            {"id": 1, "template": "{% for i in range(100) %}{% endfor %}"},
+            {"id": 2, "template": "ok"},
+        ]
+        outstream = io.StringIO()
+        c = Core({"--max-loop": "10"})
+        c.handle_stream(io.StringIO(u"\n".join(json.dumps(r) for r in requests)), outstream)
+
+        responses = [json.loads(l) for l in outstream.getvalue().splitlines()]
+        assert responses[0]["error"].startswith("RenderLimitError")
+        assert responses[1]["output"] == "ok"
+
+    def test_max_output_named_outputs(self):
+        c = Core({"--max-output": "100"})
+        template = c.get_template_environment().from_string(
+            "{% for i in range(2000) %}{% output 'x' %}xxxxxxxxxx{% endoutput %}{% endfor %}")
+        with pytest.raises(RenderLimitError):
+            c.render_template(template, {}, {})
+
+    @pytest.mark.skipif(not limits._ASSIGN_BLOCK_FILTERS, reason="jinja without filtered block assignments")
+    def test_max_output_block_assignment(self):
+        source = "{% set x %}{% for i in range(2000) %}xxxxxxxxxx{% endfor %}{% endset %}{{ x|length }}"
+        with pytest.raises(RenderLimitError):
+            render(source, {"--max-output": "100"})
+        assert render("{% set x | upper %}ab{% endset %}{{ x }}", {"--max-output": "100"}) == "AB"
+
+    def test_max_loop_recursive(self):
+        source = "{% for i in items recursive %}{{ i.n }}{{ loop(i.children) }}{% endfor %}"
+        items = [{"n": 1, "children": [{"n": 2, "children": [{"n": n, "children": []} for n in range(3, 8)]}]}]
+        assert render(source, {"--max-loop": "7"}, items=items) == "1234567"
+        with pytest.raises(RenderLimitError):
+            render(source, {"--max-loop": "6"}, items=items)
+
+    def test_power(self):
+        assert render("{{ 2 ** 10 }}", {"--timeout": "10"}) == "1024"
+        with pytest.raises(RenderLimitError):
+            render("{{ n ** 3000000 }}", {"--timeout": "0.5"}, n=7)
+        with pytest.raises(RenderLimitError):
+            render("{{ 10 ** 200 }}", {"--max-output": "100"})
+
+    def test_string_filters(self):
+        args = {"--max-output": "1000"}
+        assert render("{{ 'x'|center(5) }}|{{ 'a'|replace('a', 'bb') }}", args) == "  x  |bb"
+        for source in (
+            "{{ 'x'|center(200000000)|length }}",
+            "{{ 'x'|indent(200000000, true)|length }}",
+            "{{ ('x' * 500)|replace('x', 'yyyy')|length }}",
+            "{{ '%0200000000d'|format(1)|length }}",
+            "{{ range(2000)|join(',')|length }}",
+        ):
+            with pytest.raises(RenderLimitError):
+                render(source, args)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# djinja package imports
+from djinja.main import Core
+from djinja.partial import Specializer, specialize
+
+# 3rd party imports
+import pytest
+from jinja2 import nodes
+
+TEMPLATE = """FROM {{ base }}:{{ version }}
+{% for p in packages %}RUN install {{ p }}
+{% endfor %}{% if OS == 'ubuntu' %}RUN apt-get update
+{% endif %}{% set tag = version ~ '-' ~ OS %}LABEL tag={{ tag }} os={{ OS|upper }}
+{% macro run(cmd) %}RUN {{ cmd }}{% endmacro %}{{ run(base) }}
+{{ missing }}|{{ packages|length }}
+"""
+
+
+class TestSpecialize(object):
+
+    def setup_method(self, method):
+        self.core = Core({})
+        self.environment = self.core.get_template_environment()
+        self.constant = {
+            "base": "debian",
+            "version": "8",
+            "packages": ["curl", "git"],
+        }
+
+    def specialize(self, source, varying):
+        return specialize(self.environment, source, self.constant, varying, self.core.render_template)
+
+    @pytest.mark.parametrize("OS", ["ubuntu", "centos"])
+    def test_output_identical(self, OS):
+        """
+        Residual template must render exactly like the original template
+        """
+        residual = self.specialize(TEMPLATE, ["OS"])
+        context = dict(self.constant, OS=OS)
+
+        expected = self.environment.from_string(TEMPLATE).render(**context)
+        assert self.core.render_template(residual, context) == expected
+
+    def test_constant_parts_folded(self):
+        """
+        Parts that only use constant data should be replaced by their output
+        """
+        tree = self.environment.parse("FROM {{ base }}\n{% for p in packages %}{{ p }}{% endfor %}{{ OS }}")
+        residual = Specializer(self.environment, self.constant, ["OS"], self.core.render_template).fold(tree)
+
+        assert residual.find(nodes.For) is None
+        output = residual.find(nodes.Output)
+        assert isinstance(output.nodes[0], nodes.TemplateData)
+        assert output.nodes[0].data == "FROM debian\ncurlgit"
+        assert [n.name for n in residual.find_all(nodes.Name)] == ["OS"]
+
+    def test_extends_not_specialized(self):
+        """
+        Templates using inheritance are compiled as they are
+        """
+        residual = self.specialize("{% extends 'base' %}", ["OS"])
+        assert residual is not None
+
+
+def test_compile_template_vary(tmpdir):
+    """
+    With --vary the residual template is cached and reused between renders
+    """
+    inp = tmpdir.join("Dockerfile.jinja")
+    inp.write("FROM {{ base }}:{{ OS }}")
+    out = tmpdir.join("Dockerfile")
+
+    c = Core({
+        "--dockerfile": str(inp),
+        "--outfile": str(out),
+        "--vary": ["OS"],
+    })
+    c.config.merge_data_tree({"base": "debian", "OS": "8"})
+    c.handle_dockerfile()
+    assert out.read() == "FROM debian:8"
+
+    # Only the varying name changes, the residual template is reused
+    c.config.tree["OS"] = "9"
+    c.handle_dockerfile()
+    assert out.read() == "FROM debian:9"
+    assert len(c.templates) == 1
+
+    # Merged config data invalidates it, output stays identical to a full render
+    c.config.merge_data_tree({"base": "changed", "OS": "10"})
+    c.handle_dockerfile()
+    assert out.read() == "FROM changed:10"